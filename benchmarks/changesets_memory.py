@@ -0,0 +1,66 @@
+"""
+Measure the memory used to hold all the changesets of a synthetic corpus,
+with records as Python dicts, compared to compact ``RawRecords``.
+
+    PYTHONPATH=. python benchmarks/changesets_memory.py [nb_collections] [nb_records]
+"""
+
+import sys
+import time
+import tracemalloc
+
+from commands.build_bundles import RawRecords
+
+
+def synthetic_changeset(c, nb_records):
+    return {
+        "metadata": {"bucket": "main", "id": f"collection-{c}", "flags": []},
+        "timestamp": 1720004688000 + c,
+        "changes": [
+            {
+                "id": f"record-{c}-{r}",
+                "last_modified": 1720004688000 + r,
+                "name": f"Record number {r} of collection {c}",
+                "filter_expression": "env.version|versionCompare('128.0a1') >= 0",
+            }
+            for r in range(nb_records)
+        ],
+    }
+
+
+def as_dicts(changeset):
+    return changeset
+
+
+def as_raw_records(changeset):
+    # Like ``fetch_all_changesets()``, each changeset is compacted once obtained.
+    changeset["changes"] = RawRecords(changeset["changes"])
+    return changeset
+
+
+def measure(convert, nb_collections, records_per_collection):
+    tracemalloc.start()
+    started = time.perf_counter()
+    changesets = [
+        convert(synthetic_changeset(c, records_per_collection)) for c in range(nb_collections)
+    ]
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del changesets
+    return current, peak, elapsed
+
+
+def main(nb_collections=500, nb_records=1_000_000):
+    records_per_collection = max(1, nb_records // nb_collections)
+    print(f"{nb_collections} collections, {records_per_collection * nb_collections} records")
+    for label, convert in [("dicts", as_dicts), ("RawRecords", as_raw_records)]:
+        current, peak, elapsed = measure(convert, nb_collections, records_per_collection)
+        print(
+            f"{label:<12} held: {current / 1e6:8.1f}MB  peak: {peak / 1e6:8.1f}MB"
+            f"  ({elapsed:.1f}s)"
+        )
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,71 @@
+"""
+Measure the peak memory used to write a ``changesets.json.mozlz4`` file
+for a synthetic corpus, compared to serializing the whole corpus at once.
+
+    PYTHONPATH=. python benchmarks/mozlz4_memory.py [nb_collections] [nb_records]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import lz4.block
+
+from commands.build_bundles import write_json_mozlz4
+
+
+def synthetic_changesets(nb_collections, nb_records):
+    records_per_collection = max(1, nb_records // nb_collections)
+    return [
+        {
+            "metadata": {"bucket": "main", "id": f"collection-{c}", "flags": []},
+            "timestamp": 1720004688000 + c,
+            "changes": [
+                {
+                    "id": f"record-{c}-{r}",
+                    "last_modified": 1720004688000 + r,
+                    "name": f"Record number {r} of collection {c}",
+                    "filter_expression": "env.version|versionCompare('128.0a1') >= 0",
+                }
+                for r in range(records_per_collection)
+            ],
+        }
+        for c in range(nb_collections)
+    ]
+
+
+def write_all_at_once(output_path, changesets):
+    json_str = json.dumps(changesets).encode("utf-8")
+    compressed = lz4.block.compress(json_str)
+    with open(output_path, "wb") as f:
+        f.write(b"mozLz40\x00" + compressed)
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main(nb_collections=500, nb_records=100_000):
+    changesets = synthetic_changesets(nb_collections, nb_records)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        before = os.path.join(tmp_dir, "before.json.mozlz4")
+        after = os.path.join(tmp_dir, "after.json.mozlz4")
+        peak_before = measure(write_all_at_once, before, changesets)
+        peak_after = measure(write_json_mozlz4, after, changesets)
+        with open(before, "rb") as f1, open(after, "rb") as f2:
+            assert f1.read() == f2.read(), "Output differs"
+        size = os.path.getsize(after)
+
+    print(f"{nb_collections} collections, {nb_records} records, {size / 1e6:.1f}MB compressed")
+    print(f"Peak memory (all at once): {peak_before / 1e6:.1f}MB")
+    print(f"Peak memory (write_json_mozlz4): {peak_after / 1e6:.1f}MB")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
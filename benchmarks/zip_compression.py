@@ -0,0 +1,62 @@
+"""
+Report the size/time trade-off of the attachments Zip compression settings,
+for each of the specified bundles (eg. downloaded from the attachments CDN).
+
+    PYTHONPATH=. python benchmarks/zip_compression.py bundles/main--*.zip
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+from commands.build_bundles import is_precompressed, write_zip
+
+
+SETTINGS = [
+    # (label, compresslevel, store precompressed, workers)
+    ("deflate (before)", None, False, 0),
+    ("deflate 1", 1, False, 0),
+    ("deflate 9", 9, False, 0),
+    ("stored types + deflate", None, True, 0),
+    ("stored types + deflate 1", 1, True, 0),
+    ("stored types + deflate, 4 threads", None, True, 4),
+]
+
+
+def read_bundle(path):
+    with zipfile.ZipFile(path) as zip_file:
+        content = [(name, zip_file.read(name)) for name in zip_file.namelist()]
+    precompressed = {
+        name.removesuffix(".meta.json")
+        for name, data in content
+        if name.endswith(".meta.json") and is_precompressed(json.loads(data).get("attachment", {}))
+    }
+    return content, precompressed
+
+
+def main(*paths):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_path = os.path.join(tmp_dir, "output.zip")
+        for path in paths:
+            content, precompressed = read_bundle(path)
+            raw_size = sum(len(data) for _, data in content)
+            print(f"{os.path.basename(path)}: {len(content)} files, {raw_size / 1e6:.1f}MB raw")
+            for label, compresslevel, store_precompressed, workers in SETTINGS:
+                started = time.perf_counter()
+                write_zip(
+                    output_path,
+                    content,
+                    stored_members=precompressed if store_precompressed else (),
+                    compresslevel=compresslevel,
+                    workers=workers,
+                )
+                elapsed = time.perf_counter() - started
+                size = os.path.getsize(output_path)
+                print(f"  {label:<36} {size / 1e6:8.2f}MB {elapsed:8.3f}s")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
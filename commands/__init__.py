@@ -1,16 +1,26 @@
+import abc
+import collections
 import concurrent.futures
 import os
+import tempfile
+import threading
+import time
+import urllib.parse
 
 import backoff
 import kinto_http
 import requests
+from google.api_core.exceptions import NotFound
+from google.cloud import storage
 from requests.adapters import TimeoutSauce
 
 
 PARALLEL_REQUESTS = int(os.getenv("PARALLEL_REQUESTS", 4))
 REQUESTS_TIMEOUT_SECONDS = float(os.getenv("REQUESTS_TIMEOUT_SECONDS", 2))
 REQUESTS_NB_RETRIES = int(os.getenv("REQUESTS_NB_RETRIES", 4))
+MAX_REQUESTS_PER_SECOND_PER_HOST = float(os.getenv("MAX_REQUESTS_PER_SECOND_PER_HOST", 0))
 DRY_MODE = os.getenv("DRY_RUN", "0") in "1yY"
+SERVER_INFO_TTL_SECONDS = float(os.getenv("SERVER_INFO_TTL_SECONDS", 300))
 
 retry_timeout = backoff.on_exception(
     backoff.expo,
@@ -31,6 +41,37 @@ class CustomTimeout(TimeoutSauce):
 requests.adapters.TimeoutSauce = CustomTimeout
 
 
+def create_http_session(pool_size=PARALLEL_REQUESTS):
+    """
+    Return a ``requests`` session whose connections pool can keep alive
+    as many connections per host as there are parallel requests.
+    """
+    session = requests.Session()
+    _mount_pool(session, pool_size)
+    return session
+
+
+def resize_http_session_pool(session, pool_size):
+    """
+    Grow the connections pool of the `session`, so that it can keep alive
+    `pool_size` connections per host (eg. when requests are made from several
+    parallel pools).
+    """
+    if session.get_adapter("https://")._pool_maxsize < pool_size:
+        _mount_pool(session, pool_size)
+
+
+def _mount_pool(session, pool_size):
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+# Shared by all commands, so that connections are reused across calls
+# and across warm invocations.
+http_session = create_http_session()
+
+
 class KintoClient(kinto_http.Client):
     """
     This Kinto client will retry the requests if they fail for timeout, and
@@ -50,6 +91,10 @@ class KintoClient(kinto_http.Client):
     def get_collection(self, *args, **kwargs):
         return super().get_collection(*args, **kwargs)
 
+    @retry_timeout
+    def get_collections(self, *args, **kwargs):
+        return super().get_collections(*args, **kwargs)
+
     @retry_timeout
     def get_records(self, *args, **kwargs):
         return super().get_records(*args, **kwargs)
@@ -71,9 +116,212 @@ class KintoClient(kinto_http.Client):
         return super().request_review(*args, **kwargs)
 
 
-def call_parallel(func, args_list, max_workers=PARALLEL_REQUESTS):
-    results = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(func, *args) for args in args_list]
-        results = [future.result() for future in futures]
-    return results
+class SignerIndex:
+    """
+    Index of the signer resources of the server, by source and by destination
+    ``(bucket, collection)``, where ``collection`` is ``None`` for per-bucket
+    configurations.
+    """
+
+    def __init__(self, server_info):
+        self.config = server_info["capabilities"].get("signer", {})
+        self._indexes = {"source": {}, "destination": {}}
+        for resource in self.config.get("resources", []):
+            for side, index in self._indexes.items():
+                if side in resource:
+                    key = (resource[side]["bucket"], resource[side]["collection"])
+                    index.setdefault(key, resource)
+
+    def _lookup(self, side, bucket, collection):
+        # Per-collection configurations take precedence over per-bucket ones.
+        index = self._indexes[side]
+        return index.get((bucket, collection)) or index.get((bucket, None))
+
+    def by_source(self, bucket, collection):
+        return self._lookup("source", bucket, collection)
+
+    def by_destination(self, bucket, collection):
+        return self._lookup("destination", bucket, collection)
+
+
+class ServerInfoCache:
+    """
+    Cache of the server info and signer index of each server, shared by all
+    clients, and kept between warm invocations for `ttl_seconds`.
+    Only the parts that don't depend on the authenticated user should be read
+    (eg. ``capabilities`` and ``settings``).
+
+    The server settings are also set on each client it is used with, which is the
+    (private) attribute where kinto-http keeps them, so that batch requests don't
+    fetch them again.
+    """
+
+    def __init__(self, ttl_seconds=0):
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _get(self, client):
+        server_url = client.session.server_url
+        with self._lock:
+            entry = self._entries.get(server_url)
+        if entry is None or entry[0] <= time.monotonic():
+            server_info = client.server_info()
+            entry = (time.monotonic() + self.ttl_seconds, server_info, SignerIndex(server_info))
+            with self._lock:
+                self._entries[server_url] = entry
+        if "settings" in entry[1]:
+            client._server_settings = entry[1]["settings"]
+        return entry
+
+    def get(self, client) -> tuple[dict, SignerIndex]:
+        """
+        Return both the server info and the signer index of the `client` server.
+        """
+        return self._get(client)[1:]
+
+    def server_info(self, client):
+        return self._get(client)[1]
+
+    def signer_index(self, client):
+        return self._get(client)[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by all commands, so that the server info is fetched once per invocation.
+server_info_cache = ServerInfoCache(SERVER_INFO_TTL_SECONDS)
+
+
+class HostRateLimiter:
+    """
+    Space out the calls made to the same host, so that at most `max_per_second`
+    of them are started every second. Zero means no limit.
+    It is shared by the calls of all threads.
+    """
+
+    def __init__(self, max_per_second=0):
+        self.interval = 1 / max_per_second if max_per_second > 0 else 0
+        self._next_slots = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        if not self.interval:
+            return
+        # Each slot is booked by a single thread, and waited for outside the lock.
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slots.get(host, now))
+            self._next_slots[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Shared by all calls, so that limits apply across parallel pools.
+host_rate_limiter = HostRateLimiter(MAX_REQUESTS_PER_SECOND_PER_HOST)
+
+
+def iter_parallel(func, args_list, max_workers=PARALLEL_REQUESTS, host=None):
+    """
+    Call `func` with each arguments of `args_list` in a pool of `max_workers` threads,
+    and yield the results in order as soon as they are available.
+
+    At most `max_workers` calls are in flight or waiting to be consumed, hence
+    results don't have to be held all in memory at once, and the pool keeps running
+    calls in the background while the caller consumes the results. Calls are rate
+    limited when `host` is specified.
+    """
+
+    def call(args):
+        if host is not None:
+            host_rate_limiter.wait(host)
+        return func(*args)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    pending = collections.deque()
+    try:
+        for args in args_list:
+            if len(pending) >= max_workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(call, args))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def call_parallel(func, args_list, max_workers=PARALLEL_REQUESTS, host=None):
+    """
+    Call `func` with each arguments of `args_list` in parallel, and return the
+    list of results (see ``iter_parallel()``).
+    """
+    return list(iter_parallel(func, args_list, max_workers=max_workers, host=host))
+
+
+class FileStorage(abc.ABC):
+    """
+    Folder of files that persist between invocations, either on disk or in
+    Cloud Storage (see ``create_file_storage()``).
+    """
+
+    @abc.abstractmethod
+    def read(self, name: str) -> bytes | None:
+        """
+        Return the content of the `name` file, or ``None`` if it does not exist.
+        """
+
+    @abc.abstractmethod
+    def write(self, name: str, content: bytes, content_type: str = "application/json"): ...
+
+
+class DiskFileStorage(FileStorage):
+    def __init__(self, folder: str):
+        self.folder = folder or "."
+        os.makedirs(self.folder, exist_ok=True)
+
+    def read(self, name: str) -> bytes | None:
+        try:
+            with open(os.path.join(self.folder, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, name: str, content: bytes, content_type: str = "application/json"):
+        # Write in a temporary file first, so that concurrent readers never
+        # see partial content.
+        with tempfile.NamedTemporaryFile(dir=self.folder, suffix=".tmp", delete=False) as f:
+            f.write(content)
+        os.replace(f.name, os.path.join(self.folder, name))
+
+
+class CloudStorageFileStorage(FileStorage):
+    def __init__(self, storage_bucket: str, folder: str):
+        self.bucket = storage.Client().bucket(storage_bucket)
+        self.folder = folder
+
+    def read(self, name: str) -> bytes | None:
+        try:
+            return self.bucket.blob(os.path.join(self.folder, name)).download_as_bytes()
+        except NotFound:
+            return None
+
+    def write(self, name: str, content: bytes, content_type: str = "application/json"):
+        blob = self.bucket.blob(os.path.join(self.folder, name))
+        blob.upload_from_string(content, content_type=content_type)
+
+
+def create_file_storage(url: str) -> FileStorage:
+    """
+    Return the file storage for the specified folder `url`, either a local folder
+    (``/path`` or ``file:///path``) or a Cloud Storage folder (``gs://bucket/folder``).
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "gs":
+        return CloudStorageFileStorage(parsed.netloc, parsed.path.strip("/"))
+    if parsed.scheme in ("", "file"):
+        return DiskFileStorage(parsed.path)
+    raise ValueError(f"Unsupported storage {url!r}")
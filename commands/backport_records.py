@@ -1,20 +1,278 @@
+import collections
 import json
 import os
+import posixpath
 import re
+import threading
+import time
 import urllib.parse
 
+import requests
 from decouple import config
+from kinto_http import KintoBatchException, KintoException
 from kinto_http.utils import collection_diff
 
+from . import DRY_MODE, PARALLEL_REQUESTS, call_parallel, create_file_storage, server_info_cache
 from . import KintoClient as Client
 
 
+# Querystring filters operators of the server (eg. ``min_age=20``).
+FILTERS_OPERATORS = ("eq", "not", "in", "exclude", "has")
+UNSUPPORTED_FILTERS_OPERATORS = ("min", "max", "lt", "gt", "like", "contains", "contains_any")
+
+
+# Destination records are read by ids in incremental mode, up to this number.
+MAX_INCREMENTAL_IDS = 100
+
+# Changes are sent in batch requests of this size (default is the server limit),
+# several at a time. Batches that fail (eg. 5XX) are sent again.
+BACKPORT_RECORDS_BATCH_SIZE = int(os.getenv("BACKPORT_RECORDS_BATCH_SIZE", 0))
+BACKPORT_RECORDS_BATCH_WORKERS = int(
+    os.getenv("BACKPORT_RECORDS_BATCH_WORKERS", PARALLEL_REQUESTS)
+)
+BACKPORT_RECORDS_BATCH_RETRIES = int(os.getenv("BACKPORT_RECORDS_BATCH_RETRIES", 2))
+
+
+class BackportError(Exception):
+    pass
+
+
 def parse_querystring(qs):
     query_dict = urllib.parse.parse_qs(qs.lstrip("?"))
     # Convert the list values to single values for convenience
     return {key: value[0] if len(value) == 1 else value for key, value in query_dict.items()}
 
 
+def native_value(value):
+    # Like the server does, eg. ``"true"`` -> ``True``, ``"20"`` -> ``20``.
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def filter_predicate(key, value):
+    """
+    Return a function that tells whether a record matches the ``key=value``
+    querystring filter, like the server would. Return ``None`` if this filter
+    is not supported locally.
+    """
+    if key.startswith("_") or not isinstance(value, str):
+        return None
+    if key.startswith(tuple(f"{op}_" for op in UNSUPPORTED_FILTERS_OPERATORS)):
+        return None
+    operator, _, field = key.partition("_")
+    if operator not in FILTERS_OPERATORS or not field:
+        operator, field = "eq", key
+    path = field.split(".")
+
+    def lookup(record):
+        for name in path:
+            if not isinstance(record, dict) or name not in record:
+                return False, None
+            record = record[name]
+        return True, record
+
+    if operator == "has":
+        expected = native_value(value) not in (False, 0, "false")
+        return lambda record: lookup(record)[0] == expected
+    if operator in ("in", "exclude"):
+        values = [native_value(v) for v in value.split(",")]
+        if operator == "in":
+            return lambda record: lookup(record) in [(True, v) for v in values]
+        return lambda record: lookup(record) not in [(True, v) for v in values]
+    if operator == "not":
+        return lambda record: lookup(record) != (True, native_value(value))
+    return lambda record: lookup(record) == (True, native_value(value))
+
+
+def filter_records(records, filters):
+    """
+    Return the `records` that match the querystring `filters`, or ``None``
+    if one of the filters is not supported locally.
+    """
+    predicates = [filter_predicate(key, value) for key, value in filters.items()]
+    if None in predicates:
+        return None
+    return [r for r in records if all(predicate(r) for predicate in predicates)]
+
+
+def filters_key(filters):
+    return json.dumps(filters, sort_keys=True)
+
+
+class SourcesRecords:
+    """
+    Source records of the `mappings`, read on demand by key (see ``sources_key()``).
+    Each source collection is read only once, even if several mappings use it with
+    different filters (when these filters can be applied locally), and released as
+    soon as the last of these mappings got its records. The read error is returned
+    instead of the records if it fails.
+    """
+
+    def __init__(self, server_url, source_auth, mappings):
+        self.server_url = server_url
+        self.source_auth = source_auth
+
+        by_source = {}
+        for sbid, scid, filters, _, _ in mappings:
+            by_source.setdefault((sbid, scid), {})[filters_key(filters)] = filters
+
+        # The arguments of each read, and the read that serves each key.
+        self._reads = []
+        self._read_index = {}
+        for (sbid, scid), all_filters in by_source.items():
+            # Read the whole collection once if all filters can be applied locally.
+            if len(all_filters) > 1 and all(
+                filter_records([], filters) is not None for filters in all_filters.values()
+            ):
+                self._reads.append((sbid, scid, {}))
+                for key in all_filters:
+                    self._read_index[(sbid, scid, key)] = len(self._reads) - 1
+            else:
+                for key, filters in all_filters.items():
+                    self._reads.append((sbid, scid, filters))
+                    self._read_index[(sbid, scid, key)] = len(self._reads) - 1
+
+        self._locks = [threading.Lock() for _ in self._reads]
+        self._results = {}
+        self._pending = collections.Counter(
+            self._read_index[sources_key(sbid, scid, filters)]
+            for sbid, scid, filters, _, _ in mappings
+        )
+
+    def _read(self, sbid, scid, filters):
+        source_client = Client(
+            server_url=self.server_url, bucket=sbid, collection=scid, auth=self.source_auth
+        )
+        try:
+            return source_client.get_records(**filters)
+        except (KintoException, requests.exceptions.RequestException) as e:
+            return e
+
+    def __getitem__(self, key):
+        index = self._read_index[key]
+        # Mappings that share a read wait for the first one to complete it.
+        with self._locks[index]:
+            if index not in self._results:
+                self._results[index] = self._read(*self._reads[index])
+            records = self._results[index]
+            self._pending[index] -= 1
+            if self._pending[index] <= 0:
+                del self._results[index]
+
+        read_filters = self._reads[index][2]
+        served_filters = json.loads(key[2])
+        if served_filters != read_filters and not isinstance(records, Exception):
+            # The whole collection was read for several mappings.
+            return filter_records(records, served_filters)
+        return records
+
+
+def sources_key(sbid, scid, filters):
+    return (sbid, scid, filters_key(filters))
+
+
+def apply_changes(client, operations, batch_size, max_workers, retries):
+    """
+    Send the `operations` (``(record id, batch method, arguments)``) in batch requests
+    of `batch_size`, in parallel. A batch that fails is sent again, up to `retries`
+    times, and the ones that succeeded are left alone.
+
+    Return the responses bodies of the applied changes, and the ``(record id, error)``
+    of the failed ones.
+    """
+
+    def send(chunk):
+        for attempt in range(retries + 1):
+            try:
+                with client.batch() as batch:
+                    for _, method, kwargs in chunk:
+                        getattr(batch, method)(**kwargs)
+            except KintoBatchException as e:
+                # Some of the requests were rejected (4XX), they would be again.
+                responses = [r for resp, _ in e.results for r in resp["responses"]]
+                applied = [r["body"] for r in responses if r["status"] < 400]
+                failed = [
+                    (rid, f"{r['status']} {r['body'].get('message', '')}".strip())
+                    for (rid, _, _), r in zip(chunk, responses)
+                    if r["status"] >= 400
+                ]
+                return applied, failed
+            except (KintoException, requests.exceptions.RequestException) as e:
+                # The whole batch failed (eg. 5XX, timeout). Note that the client already
+                # retried 5XX responses `REQUESTS_NB_RETRIES` times on its own. If a batch
+                # that timed out was applied anyway, its creations will be rejected with
+                # 412 when sent again, and reported as failed: the next run will find
+                # the records in sync.
+                print(f"Batch of {len(chunk)} changes failed (attempt {attempt + 1}): {e}")
+                error = e
+            else:
+                return batch.results(), []
+        return [], [(rid, str(error)) for rid, _, _ in chunk]
+
+    chunks = [operations[i : i + batch_size] for i in range(0, len(operations), batch_size)]
+    results = call_parallel(
+        send,
+        [(chunk,) for chunk in chunks],
+        max_workers=max_workers,
+        host=urllib.parse.urlparse(client.session.server_url).netloc,
+    )
+    applied = [body for chunk_applied, _ in results for body in chunk_applied]
+    failed = [f for _, chunk_failed in results for f in chunk_failed]
+    return applied, failed
+
+
+def mapping_key(sbid, scid, filters, dbid, dcid):
+    querystring = urllib.parse.urlencode(filters, doseq=True)
+    return f"{sbid}/{scid}{'?' if querystring else ''}{querystring} -> {dbid}/{dcid}"
+
+
+def read_timestamps(server_url, source_auth, dest_auth, mappings):
+    """
+    Read the current records timestamps of the source and destination of each
+    mapping (with ``HEAD`` requests). Return them by mapping key, with ``None``
+    for those that could not be read.
+    """
+
+    def read(bid, cid, auth):
+        client = Client(server_url=server_url, bucket=bid, collection=cid, auth=auth)
+        try:
+            return client.get_records_timestamp()
+        except (KintoException, requests.exceptions.RequestException):
+            return None
+
+    results = call_parallel(
+        read,
+        [
+            args
+            for sbid, scid, _, dbid, dcid in mappings
+            for args in ((sbid, scid, source_auth), (dbid, dcid, dest_auth))
+        ],
+        host=urllib.parse.urlparse(server_url).netloc,
+    )
+    return {
+        mapping_key(*mapping): (results[2 * i], results[2 * i + 1])
+        for i, mapping in enumerate(mappings)
+    }
+
+
+def read_cursors(url):
+    """
+    Read the sync cursors of the mappings from a local JSON file, or from a Cloud
+    Storage one (``gs://bucket/path.json``).
+    """
+    folder, name = posixpath.split(url)
+    content = create_file_storage(folder).read(name)
+    return json.loads(content) if content is not None else {}
+
+
+def write_cursors(url, cursors):
+    folder, name = posixpath.split(url)
+    content = json.dumps(cursors, indent=2, sort_keys=True).encode("utf-8")
+    create_file_storage(folder).write(name, content)
+
+
 def backport_records(event, context, **kwargs):
     """Backport records creations, updates and deletions from one collection to another."""
     server_url = event["server"]
@@ -79,8 +337,120 @@ def backport_records(event, context, **kwargs):
 
     safe_headers = event.get("safe_headers", config("SAFE_HEADERS", default=False, cast=bool))
 
+    # Incremental mode: only backport the changes since the last synced source
+    # timestamp of each mapping, with a full sync from time to time to fix drift.
+    cursors_url = event.get("backport_records_cursors_url") or os.getenv(
+        "BACKPORT_RECORDS_CURSORS_URL"
+    )
+    full_sync_seconds = int(
+        event.get(
+            "backport_records_full_sync_seconds",
+            os.getenv("BACKPORT_RECORDS_FULL_SYNC_SECONDS", 24 * 3600),
+        )
+    )
+    cursors = read_cursors(cursors_url) if cursors_url else {}
+    now = time.time()
+
+    # The timestamps of both sides are read before any record, so that no change can
+    # be missed. They are compared with those recorded after the last sync of each
+    # mapping (high-water mark), to skip the records download when neither side moved.
+    timestamps = (
+        read_timestamps(server_url, source_auth, dest_auth, mappings) if cursors_url else {}
+    )
+
+    unchanged = set()
+    incremental = {}
     for mapping in mappings:
-        execute_backport(server_url, source_auth, dest_auth, safe_headers, *mapping)
+        key = mapping_key(*mapping)
+        cursor = cursors.get(key)
+        if cursor is None:
+            continue
+        source_timestamp, dest_timestamp = timestamps[key]
+        if dest_timestamp is None or dest_timestamp != cursor.get("dest"):
+            # The destination was changed by someone else: reconcile with a full sync.
+            continue
+        is_full_sync_due = now - cursor["full_sync"] >= full_sync_seconds
+        if source_timestamp == cursor["since"] and not is_full_sync_due:
+            unchanged.add(key)
+        elif (
+            not is_full_sync_due
+            # Records that stop matching the filters are only seen when filtered locally.
+            and filter_records([], mapping[2]) is not None
+        ):
+            incremental[key] = cursor
+
+    # Mappings are run concurrently, and source collections are read once for all of them.
+    sources_records = SourcesRecords(
+        server_url,
+        source_auth,
+        [m for m in mappings if mapping_key(*m) not in unchanged.union(incremental)],
+    )
+
+    def run(mapping):
+        sbid, scid, filters, dbid, dcid = mapping
+        key = mapping_key(*mapping)
+        try:
+            if key in unchanged:
+                synced = execute_backport(
+                    server_url, source_auth, dest_auth, safe_headers, *mapping, unchanged=True
+                )
+            elif key in incremental:
+                synced = execute_backport(
+                    server_url,
+                    source_auth,
+                    dest_auth,
+                    safe_headers,
+                    *mapping,
+                    since=incremental[key]["since"],
+                )
+            else:
+                source_records = sources_records[sources_key(sbid, scid, filters)]
+                if isinstance(source_records, Exception):
+                    raise source_records
+                synced = execute_backport(
+                    server_url,
+                    source_auth,
+                    dest_auth,
+                    safe_headers,
+                    *mapping,
+                    source_records=source_records,
+                )
+        except (KintoException, requests.exceptions.RequestException) as e:
+            # A network failure on one mapping does not prevent the others from syncing.
+            message = f"{sbid}/{scid} -> {dbid}/{dcid}: {e}"
+            print(message)
+            return message
+
+        if cursors_url:
+            # The timestamps that were not read during the sync are the ones read before.
+            source_timestamp, dest_timestamp = (
+                synced_timestamp or timestamp
+                for synced_timestamp, timestamp in zip(synced, timestamps[key])
+            )
+            if source_timestamp and dest_timestamp:
+                is_full_sync = key not in unchanged.union(incremental)
+                cursors[key] = {
+                    "since": source_timestamp,
+                    "dest": dest_timestamp,
+                    "full_sync": now if is_full_sync else cursors[key]["full_sync"],
+                }
+        return None
+
+    errors = [
+        e
+        for e in call_parallel(
+            run,
+            [(mapping,) for mapping in mappings],
+            host=urllib.parse.urlparse(server_url).netloc,
+        )
+        if e is not None
+    ]
+    # The cursors of the failed mappings are not moved forward.
+    if cursors_url and not DRY_MODE:
+        write_cursors(cursors_url, cursors)
+
+    if len(errors) > 0:
+        raise BackportError("\n" + "\n\n".join(errors))
 
 
 def execute_backport(
@@ -93,7 +463,19 @@ def execute_backport(
     source_filters,
     dest_bucket,
     dest_collection,
+    source_records=None,
+    since=None,
+    unchanged=False,
 ):
+    """
+    Backport the source records to the destination collection. If `since` is
+    specified, only the source changes since this timestamp are backported.
+    If `unchanged` is true, the records of both sides are known to be in sync, and
+    only the destination status is checked.
+
+    Return the source and destination records timestamps after the sync, with
+    ``None`` for those that were not read.
+    """
     source_client = Client(
         server_url=server_url,
         bucket=source_bucket,
@@ -107,8 +489,33 @@ def execute_backport(
         auth=dest_auth,
     )
 
-    source_records = source_client.get_records(**source_filters)
-    dest_records = dest_client.get_records()
+    source_timestamp = dest_timestamp = None
+    if unchanged:
+        source_records = dest_records = []
+    elif since is not None:
+        # Changes include tombstones, and records that stopped matching the filters.
+        changes = source_client.get_records(_since=since)
+        source_timestamp = source_client.get_records_timestamp()
+        if not changes:
+            print(f"No changes since {since}. Nothing to do.")
+            return source_timestamp, None
+        existing = [r for r in changes if not r.get("deleted")]
+        source_records = filter_records(existing, source_filters)
+        changed_ids = {r["id"] for r in changes}
+        if len(changed_ids) <= MAX_INCREMENTAL_IDS:
+            dest_records = dest_client.get_records(in_id=sorted(changed_ids))
+        else:
+            dest_records = [r for r in dest_client.get_records() if r["id"] in changed_ids]
+    else:
+        if source_records is None:
+            source_records = source_client.get_records(**source_filters)
+            source_timestamp = source_client.get_records_timestamp()
+        dest_records = dest_client.get_records()
+    if not unchanged:
+        # Obtained along with the records, without any additional request.
+        dest_timestamp = dest_client.get_records_timestamp()
+    # The diff alters the source records (eg. strips `last_modified`).
+    source_records = [dict(r) for r in source_records]
     to_create, to_update, to_delete = collection_diff(source_records, dest_records)
 
     is_behind = to_create or to_update or to_delete
@@ -123,45 +530,48 @@ def execute_backport(
 
     if not (is_behind or has_pending_changes):
         print("Records are in sync. Nothing to do.")
-        return
+        return source_timestamp, dest_timestamp
 
-    with dest_client.batch() as dest_batch:
-        for r in to_create:
-            dest_batch.create_record(data=r)
-        for old, new in to_update:
-            # Add some concurrency control headers (make sure the
-            # destination record wasn't changed since we read it).
-            if_match = old["last_modified"] if safe_headers else None
-            dest_batch.update_record(data=new, if_match=if_match)
-        for r in to_delete:
-            dest_batch.delete_record(id=r["id"])
+    # Read the destination signing config, along with the batch settings.
+    server_info, signer_index = server_info_cache.get(dest_client)
 
-    ops_count = len(dest_batch.results())
+    operations = [(r["id"], "create_record", {"data": r}) for r in to_create]
+    for old, new in to_update:
+        # Add some concurrency control headers (make sure the
+        # destination record wasn't changed since we read it).
+        if_match = old["last_modified"] if safe_headers else None
+        operations.append((new["id"], "update_record", {"data": new, "if_match": if_match}))
+    operations.extend((r["id"], "delete_record", {"id": r["id"]}) for r in to_delete)
+
+    batch_max_requests = server_info["settings"]["batch_max_requests"]
+    applied, failed = apply_changes(
+        dest_client,
+        operations,
+        batch_size=min(BACKPORT_RECORDS_BATCH_SIZE or batch_max_requests, batch_max_requests),
+        max_workers=BACKPORT_RECORDS_BATCH_WORKERS,
+        retries=BACKPORT_RECORDS_BATCH_RETRIES,
+    )
+    ops_count = len(applied)
+    if ops_count:
+        # The destination timestamp is the one of our most recent change.
+        dest_timestamp = str(max(r["data"]["last_modified"] for r in applied))
+    if failed:
+        # Review is requested on the next run, once all changes are applied.
+        details = ", ".join(f"{rid} ({error})" for rid, error in failed)
+        raise KintoException(
+            f"{len(failed)} of {len(operations)} changes failed ({ops_count} applied): {details}"
+        )
 
     # If destination has signing, request review or auto-approve changes.
-    server_info = dest_client.server_info()
-    signer_config = server_info["capabilities"].get("signer", {})
-    signer_resources = signer_config.get("resources", [])
     # Check destination collection config (sign-off required etc.)
-    signed_dest = [
-        r
-        for r in signer_resources
-        if r["source"]["bucket"] == dest_bucket and r["source"]["collection"] == dest_collection
-    ]
-    if len(signed_dest) == 0:
-        # Not explicitly configured. Check if configured at bucket level?
-        signed_dest = [
-            r
-            for r in signer_resources
-            if r["source"]["bucket"] == dest_bucket and r["source"]["collection"] is None
-        ]
+    signed_dest = signer_index.by_source(dest_bucket, dest_collection)
     # Destination has no signature enabled. Nothing to do.
-    if len(signed_dest) == 0:
+    if signed_dest is None:
         print(f"Done. {ops_count} changes applied.")
-        return
+        return source_timestamp, dest_timestamp
 
-    has_autoapproval = not signed_dest[0].get(
-        "to_review_enabled", signer_config["to_review_enabled"]
+    has_autoapproval = not signed_dest.get(
+        "to_review_enabled", signer_index.config["to_review_enabled"]
     )
     if has_autoapproval:
         # Approve the changes.
@@ -171,3 +581,4 @@ def execute_backport(
         # Request review.
         dest_client.request_review(message="r?")
         print(f"Done. Requested review for {ops_count} changes.")
+    return source_timestamp, dest_timestamp
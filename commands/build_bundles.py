@@ -5,18 +5,47 @@ their metadata.
 It then uploads these zip files to Google Cloud Storage.
 """
 
-import io
+import array
+import base64
+import collections.abc
+import concurrent.futures
+import contextlib
+import fnmatch
+import functools
+import hashlib
+import itertools
 import json
+import mmap
 import os
+import re
+import struct
 import tempfile
+import threading
+import time
+import urllib.parse
 import zipfile
+import zlib
 from email.utils import parsedate_to_datetime
+from typing import Container, Iterable
 
+import backoff
 import lz4.block
 import requests
 from google.cloud import storage
 
-from . import KintoClient, call_parallel, retry_timeout
+from . import (
+    PARALLEL_REQUESTS,
+    REQUESTS_NB_RETRIES,
+    FileStorage,
+    KintoClient,
+    call_parallel,
+    create_file_storage,
+    http_session,
+    iter_parallel,
+    resize_http_session_pool,
+    retry_timeout,
+    server_info_cache,
+)
 
 
 SERVER = os.getenv("SERVER")
@@ -27,27 +56,210 @@ STORAGE_BUCKET_NAME = os.getenv(
     "STORAGE_BUCKET_NAME", f"remote-settings-{REALM}-{ENVIRONMENT}-attachments"
 )
 DESTINATION_FOLDER = os.getenv("DESTINATION_FOLDER", "bundles")
+# Cloud Storage recommends no more than 100 calls per batch.
+STORAGE_DELETE_BATCH_SIZE = 100
+# Reuse unchanged attachments from the previously published bundles.
+INCREMENTAL_BUNDLES = os.getenv("INCREMENTAL_BUNDLES", "0") in "1yY"
+DOWNLOAD_CHUNK_SIZE_BYTES = 1024 * 1024
+# Bundles of changesets, see `parse_bundles_definitions()`.
+MOZLZ4_BUNDLES = os.getenv("MOZLZ4_BUNDLES")
+DEFAULT_MOZLZ4_BUNDLES = [
+    {"name": "changesets.json.mozlz4"},
+    {"name": "startup.json.mozlz4", "flags": ["startup"]},
+]
+BUNDLE_DEFINITION_FIELDS = {"name", "flags", "buckets", "collections", "include_preview"}
+# Publish deltas between successive `changesets.json.mozlz4` snapshots.
+CHANGESETS_DELTAS = os.getenv("CHANGESETS_DELTAS", "0") in "1yY"
+CHANGESETS_DELTAS_HISTORY = int(os.getenv("CHANGESETS_DELTAS_HISTORY", "10"))
+CHANGESETS_DELTAS_MANIFEST = "changesets-deltas.json"
+# Source timestamps of the published bundles (see ``build_bundles()``).
+BUNDLES_TIMESTAMPS_MANIFEST = "bundles-timestamps.json"
+# Build attachments bundles in background workers, and upload them as soon as they are ready.
+BUNDLES_PIPELINE_WORKERS = int(os.getenv("BUNDLES_PIPELINE_WORKERS", "0"))
+# Attachments Zip compression: deflate level (also per bundle, eg. `{"main/*": 1}`),
+# types that are stored as is because they are already compressed, and parallelism.
+ZIP_COMPRESSLEVEL = int(os.getenv("ZIP_COMPRESSLEVEL", "6"))
+ZIP_COMPRESSLEVELS = json.loads(os.getenv("ZIP_COMPRESSLEVELS", "{}"))
+ZIP_STORED_TYPES = os.getenv(
+    "ZIP_STORED_TYPES",
+    "image/png,image/jpeg,image/gif,image/webp,image/avif,font/woff2,"
+    "application/zip,application/gzip,*.mozlz4,*.bin,*.zip,*.gz,*.br,*.xpi",
+).split(",")
+ZIP_COMPRESSION_WORKERS = int(os.getenv("ZIP_COMPRESSION_WORKERS", "0"))
+# Earliest date of Zip members, used when they have none.
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+# Persistent cache of changesets, on disk (eg. `/var/cache/changesets`) or in
+# Cloud Storage (eg. `gs://bucket/folder`). Disabled if not set.
+CHANGESETS_CACHE_URL = os.getenv("CHANGESETS_CACHE_URL")
+# Cached changesets are fetched again entirely once they are older than this, so that
+# changes of their metadata alone (eg. flags, signature refresh) are picked up.
+CHANGESETS_CACHE_MAX_AGE_SECONDS = int(os.getenv("CHANGESETS_CACHE_MAX_AGE_SECONDS", 24 * 3600))
+# Local attachments cache, shared by all bundles (and kept between warm runs).
+ATTACHMENTS_CACHE_DIR = os.getenv(
+    "ATTACHMENTS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "attachments-cache")
+)
+ATTACHMENTS_CACHE_MAX_SIZE_BYTES = int(
+    os.getenv("ATTACHMENTS_CACHE_MAX_SIZE_BYTES", "200_000_000")
+)
 # Flags for local development
 BUILD_ALL = os.getenv("BUILD_ALL", "0") in "1yY"
 SKIP_UPLOAD = os.getenv("SKIP_UPLOAD", "0") in "1yY"
 
 
-def fetch_all_changesets(client):
+class RawRecords(collections.abc.Sequence):
+    """
+    Compact list of records, kept as their UTF-8 JSON serializations in a single
+    buffer, which takes a fraction of the memory of Python dicts. Records are
+    decoded on access, and serialized as is in the bundles (see ``encode_changeset()``).
+    """
+
+    SEPARATOR = b", "
+
+    def __init__(self, records=()):
+        fragments = [json.dumps(record).encode("utf-8") for record in records]
+        self.data = self.SEPARATOR.join(fragments)
+        self._offsets = array.array("Q")
+        offset = 0
+        for fragment in fragments:
+            self._offsets.append(offset)
+            offset += len(fragment) + len(self.SEPARATOR)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return json.loads(self.raw(index))
+
+    def __eq__(self, other):
+        if isinstance(other, RawRecords):
+            return self.data == other.data
+        if isinstance(other, collections.abc.Sequence):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"RawRecords({list(self)!r})"
+
+    def raw(self, index: int) -> bytes:
+        """
+        Return the JSON serialization of the record at `index`.
+        """
+        index = range(len(self))[index]  # Support negative indices, raise IndexError.
+        start = self._offsets[index]
+        if index + 1 < len(self):
+            end = self._offsets[index + 1] - len(self.SEPARATOR)
+        else:
+            end = len(self.data)
+        return self.data[start:end]
+
+
+class ChangesetsCache:
+    """
+    Persistent cache of collections changesets, with one JSON file per collection
+    in the specified `files` storage.
+    Entries older than `CHANGESETS_CACHE_MAX_AGE_SECONDS` are ignored.
+    """
+
+    def __init__(self, files: FileStorage):
+        self.files = files
+
+    def get(self, bid: str, cid: str) -> dict | None:
+        content = self.files.read(f"{bid}--{cid}.json")
+        if content is None:
+            return None
+        try:
+            changeset = json.loads(content)
+        except ValueError:  # Corrupted entries are fetched again.
+            return None
+        if time.time() - changeset.pop("cached_at", 0) > CHANGESETS_CACHE_MAX_AGE_SECONDS:
+            return None
+        return changeset
+
+    def set(self, changeset):
+        metadata = changeset["metadata"]
+        entry = {**changeset, "cached_at": int(time.time())}
+        self.files.write(f"{metadata['bucket']}--{metadata['id']}.json", encode_changeset(entry))
+
+
+def merge_changes(cached_changes: list, new_changes: list) -> list:
+    """
+    Apply the `new_changes` (including tombstones) to the `cached_changes`, and
+    return the resulting records sorted like the server does (newest first).
+    """
+    records = {r["id"]: r for r in cached_changes}
+    for change in new_changes:
+        if change.get("deleted"):
+            records.pop(change["id"], None)
+        else:
+            records[change["id"]] = change
+    return sorted(records.values(), key=lambda r: r["last_modified"], reverse=True)
+
+
+def fetch_changeset(client, bid: str, cid: str, timestamp: int, cached=None):
+    """
+    Return the changeset of the specified collection at the specified `timestamp`.
+    If a previous `cached` version is specified, only the records that changed
+    since then are fetched.
+    """
+    if cached is None or cached["timestamp"] > timestamp:
+        return client.get_changeset(bid, cid, _expected=timestamp)
+    changeset = client.get_changeset(bid, cid, _expected=timestamp, _since=cached["timestamp"])
+    changeset["changes"] = merge_changes(cached["changes"], changeset["changes"])
+    return changeset
+
+
+def fetch_all_changesets(client, cache: ChangesetsCache | None = None):
     """
     Return the `/changeset` responses for all collections listed
     in the `monitor/changes` endpoint.
     The result contains the metadata and all the records of all collections
     for both preview and main buckets.
+    Collections that haven't changed since they were put in the `cache` are not fetched.
     """
     monitor_changeset = client.get_changeset("monitor", "changes", bust_cache=True)
     print("%s collections" % len(monitor_changeset["changes"]))
 
-    args_list = [
+    entries = [
         (c["bucket"], c["collection"], c["last_modified"]) for c in monitor_changeset["changes"]
     ]
-    all_changesets = call_parallel(
-        lambda bid, cid, ts: client.get_changeset(bid, cid, _expected=ts), args_list
-    )
+
+    # Records are kept compact as soon as each changeset is obtained, so that all
+    # collections are never held as Python dicts at once.
+    def load_cached(bid, cid):
+        if (changeset := cache.get(bid, cid)) is not None:
+            changeset["changes"] = RawRecords(changeset["changes"])
+        return changeset
+
+    def fetch(bid, cid, timestamp, previous):
+        changeset = fetch_changeset(client, bid, cid, timestamp, previous)
+        changeset["changes"] = RawRecords(changeset["changes"])
+        if cache is not None:
+            cache.set(changeset)
+        return changeset
+
+    if cache is not None:
+        cached = call_parallel(load_cached, [(bid, cid) for bid, cid, _ in entries])
+    else:
+        cached = [None] * len(entries)
+
+    args_list = [
+        (bid, cid, ts, previous)
+        for (bid, cid, ts), previous in zip(entries, cached)
+        if previous is None or previous["timestamp"] != ts
+    ]
+    if cache is not None:
+        print(f"{len(entries) - len(args_list)} collections unchanged since cached")
+    with contextlib.closing(
+        iter_parallel(
+            fetch, args_list, host=urllib.parse.urlparse(client.session.server_url).netloc
+        )
+    ) as fetched:
+        all_changesets = [
+            previous if previous is not None and previous["timestamp"] == ts else next(fetched)
+            for (_, _, ts), previous in zip(entries, cached)
+        ]
     return all_changesets
 
 
@@ -56,7 +268,8 @@ def get_modified_timestamp(url) -> int:
     """
     Return URL modified date as epoch millisecond.
     """
-    resp = requests.get(url)
+    # Only the headers are needed, not the content.
+    resp = http_session.head(url, allow_redirects=True)
     if not resp.ok:
         filename = url.split("/")[-1]
         print(f"No previous '{filename}' bundle found")  # happens on first run.
@@ -67,27 +280,438 @@ def get_modified_timestamp(url) -> int:
     return epoch_msec
 
 
+def get_published_timestamps(base_url: str, filenames: list[str]) -> dict[str, int]:
+    """
+    Return the modified dates of the specified published bundles as epoch milliseconds,
+    looked up concurrently.
+    """
+    args_list = [(f"{base_url}{DESTINATION_FOLDER}/{filename}",) for filename in filenames]
+    return dict(zip(filenames, call_parallel(get_modified_timestamp, args_list)))
+
+
+class AttachmentIntegrityError(Exception):
+    pass
+
+
+class BundleError(Exception):
+    pass
+
+
+class _BatchSent(Exception):
+    """
+    Leave a Cloud Storage batch context whose requests were already sent with
+    ``finish()``, since exiting it normally would send them again.
+    """
+
+
+retry_integrity = backoff.on_exception(
+    backoff.expo,
+    AttachmentIntegrityError,
+    max_tries=REQUESTS_NB_RETRIES,
+)
+
+
 @retry_timeout
-def fetch_attachment(url):
+@retry_integrity
+def fetch_attachment(url, expected_size=None, expected_hash=None):
+    """
+    Download the attachment at the specified `url`. The size and SHA-256 hash of
+    the content are verified while it is received, and a mismatch is retried.
+    """
     print("Fetch %r" % url)
-    resp = requests.get(url)
-    return resp.content
+    chunks = []
+    size = 0
+    hasher = hashlib.sha256()
+    try:
+        with http_session.get(url, stream=True) as resp:
+            if not resp.ok:
+                raise AttachmentIntegrityError(f"{url} returned HTTP {resp.status_code}")
+            for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE_BYTES):
+                size += len(chunk)
+                if expected_size is not None and size > expected_size:
+                    raise AttachmentIntegrityError(f"{url} is bigger than {expected_size} bytes")
+                hasher.update(chunk)
+                chunks.append(chunk)
+    except (
+        requests.exceptions.ChunkedEncodingError,
+        requests.exceptions.ContentDecodingError,
+    ) as e:
+        # Truncated or corrupted response body.
+        raise AttachmentIntegrityError(f"{url} could not be read: {e}") from e
+    if expected_size is not None and size != expected_size:
+        raise AttachmentIntegrityError(f"{url} has {size} bytes instead of {expected_size}")
+    if expected_hash is not None and hasher.hexdigest() != expected_hash:
+        raise AttachmentIntegrityError(
+            f"{url} has hash {hasher.hexdigest()} instead of {expected_hash}"
+        )
+    return b"".join(chunks)
+
+
+class AttachmentsCache:
+    """
+    Content-addressed cache of attachments on disk, where files are named after
+    the SHA-256 hash of their content.
+    The least recently used files are evicted when the total size of the cache
+    exceeds `max_size_bytes`, down to `EVICTION_RATIO` of it, so that the folder
+    is not scanned again on each of the following writes.
+    """
+
+    HASH_REGEXP = re.compile(r"^[0-9a-f]{64}$")
+    TMP_SUFFIX = ".tmp"
+    EVICTION_RATIO = 0.9
+
+    def __init__(self, folder: str, max_size_bytes: int):
+        self.folder = folder
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(folder, exist_ok=True)
+        # The total size is only read from disk once, and then kept up to date.
+        self._lock = threading.Lock()
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def get(self, hash: str) -> bytes | None:
+        if not self.HASH_REGEXP.match(hash):
+            return None
+        path = os.path.join(self.folder, hash)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            # Mark as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return content
+
+    def set(self, hash: str, content: bytes) -> bool:
+        """
+        Store the `content` if it matches the specified `hash`.
+        Return ``False`` if it doesn't.
+        """
+        if not self.HASH_REGEXP.match(hash) or hashlib.sha256(content).hexdigest() != hash:
+            return False
+        if len(content) > self.max_size_bytes:
+            return True
+        path = os.path.join(self.folder, hash)
+        if os.path.exists(path):  # Stored concurrently.
+            return True
+        # Write in a temporary file first, so that concurrent readers never
+        # see partial content.
+        with tempfile.NamedTemporaryFile(
+            dir=self.folder, suffix=self.TMP_SUFFIX, delete=False
+        ) as f:
+            f.write(content)
+        os.replace(f.name, path)
+        with self._lock:
+            self._size += len(content)
+            if self._size > self.max_size_bytes:
+                self.evict()
+        return True
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(self.TMP_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # evicted concurrently.
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = self._entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_bytes * self.EVICTION_RATIO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        self._size = total_size
+
+
+def get_attachment(cache: AttachmentsCache | None, base_url: str, record) -> bytes:
+    """
+    Return the attachment content of the specified `record`, from the `cache`
+    if available, or from the attachments CDN otherwise.
+    """
+    attachment = record["attachment"]
+    hash = attachment.get("hash")
+    if cache is not None and hash:
+        if (content := cache.get(hash)) is not None:
+            return content
+    try:
+        content = fetch_attachment(
+            f"{base_url}{attachment['location']}",
+            expected_size=attachment.get("size"),
+            expected_hash=hash,
+        )
+    except AttachmentIntegrityError as e:
+        raise AttachmentIntegrityError(f"Record {record['id']!r}: {e}") from e
+    if cache is not None and hash:
+        if not cache.set(hash, content):
+            print(f"Attachment of {record['id']!r} does not match its hash. Not cached.")
+    return content
+
+
+@retry_timeout
+def download_file(url: str, output_path: str) -> bool:
+    """
+    Download the specified `url` to `output_path`, streaming the body to disk.
+    Return ``False`` if the file could not be found.
+    """
+    with http_session.get(url, stream=True) as resp:
+        if not resp.ok:
+            return False
+        with open(output_path, "wb") as f:
+            for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE_BYTES):
+                f.write(chunk)
+    return True
+
+
+def reusable_attachments(zip_path: str, records) -> set[str]:
+    """
+    Return the ids of the `records` whose attachment can be copied as-is from the
+    previously published bundle at `zip_path`, ie. whose `{id}.meta.json` in the
+    bundle has the same attachment hash and size, and whose member content matches
+    them (bundles built before attachments were checked may contain bad content).
+    """
+    try:
+        zip_file = zipfile.ZipFile(zip_path)
+    except (FileNotFoundError, zipfile.BadZipFile):
+        return set()
+
+    reusable = set()
+    with zip_file:
+        members = set(zip_file.namelist())
+        for record in records:
+            rid = record["id"]
+            if rid not in members or f"{rid}.meta.json" not in members:
+                continue
+            previous = json.loads(zip_file.read(f"{rid}.meta.json")).get("attachment", {})
+            current = record["attachment"]
+            if (
+                current.get("hash") is not None
+                and previous.get("hash") == current["hash"]
+                and previous.get("size") == current.get("size")
+                and zip_file.getinfo(rid).file_size == current.get("size")
+                and zip_member_sha256(zip_file, rid) == current["hash"]
+            ):
+                reusable.add(rid)
+    return reusable
+
+
+def zip_member_sha256(zip_file: zipfile.ZipFile, name: str) -> str | None:
+    """
+    Return the SHA-256 hash of the decompressed `name` member, or ``None`` if
+    it cannot be read.
+    """
+    hasher = hashlib.sha256()
+    try:
+        with zip_file.open(name) as member:
+            while chunk := member.read(DOWNLOAD_CHUNK_SIZE_BYTES):
+                hasher.update(chunk)
+    except (zipfile.BadZipFile, zlib.error, EOFError):
+        return None
+    return hasher.hexdigest()
+
+
+def is_precompressed(attachment) -> bool:
+    """
+    Return True if the `attachment` is already compressed according to its
+    mimetype or file name, and hence would not benefit from deflate.
+    """
+    values = (attachment.get("mimetype", ""), attachment.get("filename", "").lower())
+    return any(
+        fnmatch.fnmatchcase(value, pattern) for value in values for pattern in ZIP_STORED_TYPES
+    )
+
+
+def bundle_compresslevel(bid: str, cid: str) -> int:
+    """
+    Return the deflate level of the `{bid}--{cid}.zip` bundle.
+    """
+    for pattern, level in ZIP_COMPRESSLEVELS.items():
+        if fnmatch.fnmatchcase(f"{bid}/{cid}", pattern):
+            return level
+    return ZIP_COMPRESSLEVEL
+
+
+def write_raw_zip_member(dest: zipfile.ZipFile, info: zipfile.ZipInfo, chunks: Iterable[bytes]):
+    """
+    Append a member to the `dest` Zip, whose `info` is filled (CRC, sizes...)
+    and whose `chunks` are already compressed.
+    """
+    # Same as what ``ZipFile.mkdir()`` does, but with the raw content appended.
+    # This relies on ``ZipFile`` internals, checked on CPython 3.11, 3.12 and 3.13.
+    if dest._writing:
+        raise ValueError("Can't write to ZIP archive while an open writing handle exists")
+    with dest._lock:
+        if dest._seekable:
+            dest.fp.seek(dest.start_dir)
+        info.header_offset = dest.fp.tell()
+        dest._writecheck(info)
+        dest._didModify = True
+        dest.fp.write(info.FileHeader())
+        for chunk in chunks:
+            dest.fp.write(chunk)
+        dest.filelist.append(info)
+        dest.NameToInfo[info.filename] = info
+        dest.start_dir = dest.fp.tell()
+
+
+def copy_zip_member(source: zipfile.ZipFile, dest: zipfile.ZipFile, name: str):
+    """
+    Copy the `name` member of the `source` Zip into the `dest` Zip, without
+    decompressing and compressing its content again.
+    """
+    info = source.getinfo(name)
+    # The compressed data starts right after the local file header, whose
+    # variable length fields sizes are stored at the end of its fixed part.
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(zipfile.sizeFileHeader)
+    filename_length, extra_length = struct.unpack("<HH", header[26:30])
+    source.fp.seek(info.header_offset + zipfile.sizeFileHeader + filename_length + extra_length)
+
+    copied = zipfile.ZipInfo(info.filename, info.date_time)
+    copied.compress_type = info.compress_type
+    copied.external_attr = info.external_attr
+    copied.CRC = info.CRC
+    copied.compress_size = info.compress_size
+    copied.file_size = info.file_size
 
+    def read_chunks():
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = source.fp.read(min(remaining, DOWNLOAD_CHUNK_SIZE_BYTES))
+            yield chunk
+            remaining -= len(chunk)
 
-def write_zip(output_path: str, content: list[tuple[str, bytes]]):
+    write_raw_zip_member(dest, copied, read_chunks())
+
+
+def zip_date_time(timestamp: int) -> tuple:
+    """
+    Return the Zip member date of the specified epoch milliseconds `timestamp`.
+    """
+    return max(ZIP_EPOCH, time.gmtime(timestamp / 1000)[:6])
+
+
+def zip_member_info(filename: str, compress_type: int, date_time: tuple = None):
+    # Members have a fixed date, so that the same content always gives the same Zip.
+    info = zipfile.ZipInfo(filename, date_time or ZIP_EPOCH)
+    info.compress_type = compress_type
+    info.external_attr = 0o600 << 16
+    return info
+
+
+def compress_zip_member(
+    filename: str,
+    content: bytes,
+    compress_type: int,
+    compresslevel: int = None,
+    date_time: tuple = None,
+) -> tuple[zipfile.ZipInfo, bytes]:
+    """
+    Compress the `content` of a Zip member, exactly like ``ZipFile.writestr()`` would,
+    but without a Zip file. ``zlib`` releases the GIL, hence members can be compressed
+    in parallel threads.
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    info = zip_member_info(filename, compress_type, date_time)
+    info.CRC = zlib.crc32(content)
+    info.file_size = len(content)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        level = zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        content = compressor.compress(content) + compressor.flush()
+    info.compress_size = len(content)
+    return info, content
+
+
+def write_zip(
+    output_path: str,
+    content: Iterable[tuple[str, bytes]],
+    reused_from: str = None,
+    reused_members: Iterable[str] = (),
+    stored_members: Container[str] = (),
+    compresslevel: int = None,
+    workers: int = 0,
+):
     """
     Write a Zip at the specified `output_path` location with the specified `content`.
-    The content is specified as a list of file names and their binary content.
+    The content is specified as an iterable of file names and their binary content,
+    optionally followed by their date (see ``zip_date_time()``).
+    Entries are written to disk as soon as they are consumed, hence passing a generator
+    allows to keep only a few of them in memory at a time.
+    The `reused_members` of the `reused_from` Zip are copied without being recompressed.
+    The `stored_members` are not compressed, the others are deflated at `compresslevel`,
+    by `workers` parallel threads if specified.
     """
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for filename, filecontent in content:
-            zip_file.writestr(filename, filecontent)
-    with open(output_path, "wb") as f:
-        f.write(zip_buffer.getvalue())
+    with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        if reused_members:
+            with zipfile.ZipFile(reused_from) as previous_zip:
+                for name in reused_members:
+                    copy_zip_member(previous_zip, zip_file, name)
+        members = (
+            (
+                filename,
+                filecontent,
+                zipfile.ZIP_STORED if filename in stored_members else zipfile.ZIP_DEFLATED,
+                compresslevel,
+                date_time[0] if date_time else None,
+            )
+            for filename, filecontent, *date_time in content
+        )
+        if workers > 0:
+            compressed_members = iter_parallel(compress_zip_member, members, max_workers=workers)
+            for info, compressed in compressed_members:
+                write_raw_zip_member(zip_file, info, [compressed])
+        else:
+            for filename, filecontent, compress_type, level, date_time in members:
+                info = zip_member_info(filename, compress_type, date_time)
+                zip_file.writestr(info, filecontent, compress_type, level)
     print("Wrote %r" % output_path)
 
 
+def encode_changeset(changeset) -> bytes:
+    """
+    Return the UTF-8 JSON serialization of the `changeset`, identical to
+    ``json.dumps(changeset).encode("utf-8")``, where compact records are
+    copied as is instead of being decoded and encoded again.
+    """
+    members = []
+    for key, value in changeset.items():
+        if key == "changes" and isinstance(value, RawRecords):
+            encoded = b"[" + value.data + b"]"
+        else:
+            encoded = json.dumps(value).encode("utf-8")
+        members.append(json.dumps(key).encode("utf-8") + b": " + encoded)
+    return b"{" + b", ".join(members) + b"}"
+
+
+def write_json_list(f, items, encode=None):
+    """
+    Serialize the `items` list as UTF-8 JSON into the `f` file, one item at a time,
+    so that the whole document is never held in memory.
+    The output is identical to ``json.dumps(items).encode("utf-8")``.
+    """
+    if encode is None:
+
+        def encode(item):
+            return json.dumps(item).encode("utf-8")
+
+    f.write(b"[")
+    for i, item in enumerate(items):
+        if i > 0:
+            f.write(b", ")
+        f.write(encode(item))
+    f.write(b"]")
+
+
 def write_json_mozlz4(output_path: str, changesets):
     """
     Write a UTF-8 text file compressed as LZ4.
@@ -98,13 +722,128 @@ def write_json_mozlz4(output_path: str, changesets):
     https://bugzilla.mozilla.org/show_bug.cgi?id=1209390
     """
     header_magic_number = b"mozLz40\x00"
-    json_str = json.dumps(changesets).encode("utf-8")
-    compressed = lz4.block.compress(json_str)
+    # Firefox expects a single LZ4 block, hence the whole JSON has to be compressed
+    # at once. Instead of building it in memory, it is streamed to a temporary file
+    # that is then memory-mapped for the compression.
+    with tempfile.TemporaryFile() as json_file:
+        write_json_list(json_file, changesets, encode=encode_changeset)
+        json_file.flush()
+        with mmap.mmap(json_file.fileno(), 0, access=mmap.ACCESS_READ) as json_bytes:
+            compressed = lz4.block.compress(json_bytes)
     with open(output_path, "wb") as f:
-        f.write(header_magic_number + compressed)
+        f.write(header_magic_number)
+        f.write(compressed)
     print("Wrote %r" % output_path)
 
 
+def read_json_mozlz4(path: str):
+    """
+    Read a file written by ``write_json_mozlz4()``.
+    """
+    with open(path, "rb") as f:
+        header_magic_number = f.read(8)
+        if header_magic_number != b"mozLz40\x00":
+            raise ValueError(f"{path!r} is not a mozlz4 file")
+        return json.loads(lz4.block.decompress(f.read()))
+
+
+def changesets_delta(previous, current) -> list:
+    """
+    Return the changes between two lists of changesets, as a list of changesets
+    that only contain the created and updated records, and tombstones for the
+    deleted ones (like ``kinto_http.utils.collection_diff()``, but without altering
+    the records). Collections that were removed are marked as deleted.
+    """
+    previous_by_cid = {(c["metadata"]["bucket"], c["metadata"]["id"]): c for c in previous}
+    delta = []
+    for changeset in current:
+        key = (changeset["metadata"]["bucket"], changeset["metadata"]["id"])
+        previous_changeset = previous_by_cid.pop(key, {"metadata": None, "changes": []})
+        previous_by_id = {r["id"]: r for r in previous_changeset["changes"]}
+        changes = []
+        for record in changeset["changes"]:
+            previous_record = previous_by_id.pop(record["id"], None)
+            # Records are compared as a whole (including `last_modified`), so that the
+            # previous snapshot plus the delta matches the signed collection.
+            if record != previous_record:
+                changes.append(record)
+        changes.extend({"id": rid, "deleted": True} for rid in previous_by_id)
+        if changes or changeset["metadata"] != previous_changeset["metadata"]:
+            delta.append(
+                {
+                    "metadata": changeset["metadata"],
+                    "timestamp": changeset["timestamp"],
+                    "changes": changes,
+                }
+            )
+    for changeset in previous_by_cid.values():
+        delta.append({"metadata": changeset["metadata"], "deleted": True, "changes": []})
+    return delta
+
+
+@retry_timeout
+def fetch_json(url: str, default=None):
+    resp = http_session.get(url)
+    if not resp.ok:
+        return default
+    return resp.json()
+
+
+def build_changesets_delta(
+    base_url: str, snapshot_file: str, changesets
+) -> tuple[list[str], list[str]]:
+    """
+    Build the delta between the previously published `snapshot_file` and the
+    specified `changesets`, and update the deltas manifest.
+    Return the lists of files to upload and to delete.
+    """
+    previous_snapshot_file = f"previous--{snapshot_file}"
+    if not download_file(
+        f"{base_url}{DESTINATION_FOLDER}/{snapshot_file}", previous_snapshot_file
+    ):
+        print(f"No previous {snapshot_file!r} to compute delta from")
+        return [], []
+    previous = read_json_mozlz4(previous_snapshot_file)
+    previous_timestamp = max((c["timestamp"] for c in previous), default=0)
+    current_timestamp = max((c["timestamp"] for c in changesets), default=0)
+    if previous_timestamp >= current_timestamp:
+        print(f"No delta since {previous_timestamp}")
+        return [], []
+
+    delta_file = f"changesets-delta--{previous_timestamp}--{current_timestamp}.json.mozlz4"
+    write_json_mozlz4(delta_file, changesets_delta(previous, changesets))
+
+    manifest = fetch_json(
+        f"{base_url}{DESTINATION_FOLDER}/{CHANGESETS_DELTAS_MANIFEST}", default={"deltas": []}
+    )
+    deltas = [d for d in manifest["deltas"] if d["to"] <= previous_timestamp] + [
+        {
+            "from": previous_timestamp,
+            "to": current_timestamp,
+            "filename": delta_file,
+            "size": os.path.getsize(delta_file),
+        }
+    ]
+    expired = deltas[:-CHANGESETS_DELTAS_HISTORY]
+    manifest = {"timestamp": current_timestamp, "deltas": deltas[-CHANGESETS_DELTAS_HISTORY:]}
+    with open(CHANGESETS_DELTAS_MANIFEST, "w") as f:
+        json.dump(manifest, f)
+    print(f"Wrote {delta_file!r} and {CHANGESETS_DELTAS_MANIFEST!r}")
+    return [delta_file, CHANGESETS_DELTAS_MANIFEST], [d["filename"] for d in expired]
+
+
+def file_md5(path: str) -> str:
+    """
+    Return the base64-encoded MD5 digest of the file content, as exposed
+    in the Cloud Storage objects metadata.
+    """
+    hasher = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(DOWNLOAD_CHUNK_SIZE_BYTES):
+            hasher.update(chunk)
+    return base64.b64encode(hasher.digest()).decode()
+
+
 def sync_cloud_storage(
     storage_bucket: str, remote_folder: str, to_upload: list[str], to_delete: list[str]
 ):
@@ -116,18 +855,240 @@ def sync_cloud_storage(
     # to the path of your Google Cloud service account key file before running this script.
     client = storage.Client()
     bucket = client.bucket(storage_bucket)
-    for filename in to_upload:
+
+    def upload(filename):
         remote_file_path = os.path.join(remote_folder, filename)
+        # Identical content is not uploaded again, to avoid invalidating CDN caches.
+        existing = bucket.get_blob(remote_file_path)
+        if existing is not None and existing.md5_hash == file_md5(filename):
+            print(f"gs://{storage_bucket}/{remote_file_path} has same content. Skip upload.")
+            return
         blob = bucket.blob(remote_file_path)
         blob.upload_from_filename(filename)
         print(f"Uploaded {filename} to gs://{storage_bucket}/{remote_file_path}")
 
-    to_delete = {os.path.join(remote_folder, f) for f in to_delete}
-    blobs = bucket.list_blobs(prefix=remote_folder)
-    for blob in blobs:
-        if blob.name in to_delete:
-            blob.delete()
-            print(f"Deleted gs://{storage_bucket}/{blob.name}")
+    call_parallel(upload, [(filename,) for filename in to_upload])
+
+    # Delete blobs by name, without listing the folder. Blobs that
+    # don't exist are ignored, other failures are raised once all are sent.
+    failed = []
+    for i in range(0, len(to_delete), STORAGE_DELETE_BATCH_SIZE):
+        chunk = to_delete[i : i + STORAGE_DELETE_BATCH_SIZE]
+        with contextlib.suppress(_BatchSent), client.batch(raise_exception=False) as batch:
+            for filename in chunk:
+                bucket.delete_blob(os.path.join(remote_folder, filename))
+            # One response per deleted blob.
+            responses = batch.finish(raise_exception=False)
+            raise _BatchSent()
+        for filename, response in zip(chunk, responses):
+            remote_file_path = f"gs://{storage_bucket}/{remote_folder}/{filename}"
+            if 200 <= response.status_code < 300:
+                print(f"Deleted {remote_file_path}")
+            elif response.status_code == 404:
+                print(f"{remote_file_path} does not exist. Skip delete.")
+            else:
+                print(f"Could not delete {remote_file_path}: HTTP {response.status_code}")
+                failed.append(f"{filename} (HTTP {response.status_code})")
+    if failed:
+        raise BundleError(f"Could not delete {', '.join(failed)}")
+
+
+def _is_reserved_bundle_name(name: str) -> bool:
+    return (
+        name.endswith(".zip")  # Attachments bundles.
+        or name.startswith(("previous--", "changesets-delta--"))
+        or name in (CHANGESETS_DELTAS_MANIFEST, BUNDLES_TIMESTAMPS_MANIFEST)
+    )
+
+
+def parse_bundles_definitions(definitions) -> list[dict]:
+    """
+    Parse and validate the mozlz4 bundles definitions, specified as a JSON list
+    (or an already parsed list) of objects with the following fields:
+
+    - ``name``: the bundle filename (eg. ``"startup.json.mozlz4"``)
+    - ``flags`` (optional): only collections with one of these metadata flags
+    - ``buckets`` (optional): only collections whose bucket matches one of these patterns
+    - ``collections`` (optional): only these collections (eg. ``"main/regions"``)
+    - ``include_preview`` (optional): also include preview buckets (default: ``false``)
+
+    They are added to the default bundles, and replace those with the same name.
+    """
+    if isinstance(definitions, str):
+        definitions = json.loads(definitions or "[]")
+    definitions = definitions or []
+    names = set()
+    for definition in definitions:
+        if "name" not in definition:
+            raise ValueError(f"Missing name in bundle definition {definition}")
+        if _is_reserved_bundle_name(definition["name"]):
+            raise ValueError(f"Bundle name {definition['name']!r} is reserved")
+        if unknown := set(definition.keys()) - BUNDLE_DEFINITION_FIELDS:
+            raise ValueError(f"Unknown fields {sorted(unknown)} in bundle {definition['name']!r}")
+        for field in ("flags", "buckets", "collections"):
+            values = definition.get(field, [])
+            if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+                raise ValueError(
+                    f"Field {field!r} of bundle {definition['name']!r} must be a list of strings"
+                )
+        if definition["name"] in names:
+            raise ValueError(f"Bundle {definition['name']!r} is defined twice")
+        names.add(definition["name"])
+    overridden = {definition["name"]: definition for definition in definitions}
+    return [
+        overridden.pop(definition["name"], definition) for definition in DEFAULT_MOZLZ4_BUNDLES
+    ] + list(overridden.values())
+
+
+def _in_bundle_scope(definition, metadata) -> bool:
+    bid = metadata["bucket"]
+    if "preview" in bid and not definition.get("include_preview", False):
+        return False
+    if "buckets" in definition and not any(
+        fnmatch.fnmatchcase(bid, pattern) for pattern in definition["buckets"]
+    ):
+        return False
+    if "collections" in definition and f"{bid}/{metadata['id']}" not in definition["collections"]:
+        return False
+    return True
+
+
+def select_bundles_changesets(definitions, changesets) -> tuple[dict, dict]:
+    """
+    Return the changesets of each bundle, and the latest change timestamp that
+    the freshness of each bundle depends on, in one pass over all `changesets`.
+    """
+    selected = {definition["name"]: [] for definition in definitions}
+    latest_timestamps = {definition["name"]: -1 for definition in definitions}
+    for changeset in changesets:
+        metadata = changeset["metadata"]
+        for definition in definitions:
+            if not _in_bundle_scope(definition, metadata):
+                continue
+            name = definition["name"]
+            # Collections excluded because of their flags are taken into account
+            # for freshness too, since removing a flag changes the bundle content.
+            latest_timestamps[name] = max(latest_timestamps[name], changeset["timestamp"])
+            if "flags" in definition and not set(definition["flags"]) & set(
+                metadata.get("flags", [])
+            ):
+                continue
+            selected[name].append(changeset)
+    return selected, latest_timestamps
+
+
+def build_attachments_bundle(
+    base_url: str,
+    attachments_cache: AttachmentsCache | None,
+    filename: str,
+    records,
+    existing_bundle_timestamp: int,
+    metas: list[bytes],
+    compresslevel: int = None,
+) -> str:
+    """
+    Fetch the attachments of the specified `records` and build the `filename` Zip.
+    The `metas` are the JSON serializations of `records`, in the same order.
+    """
+    # Attachments that haven't changed since the previous bundle are copied from it.
+    previous_bundle_filename = f"previous--{filename}"
+    reused = set()
+    if (
+        INCREMENTAL_BUNDLES
+        and existing_bundle_timestamp > 0
+        and download_file(f"{base_url}{DESTINATION_FOLDER}/{filename}", previous_bundle_filename)
+    ):
+        reused = reusable_attachments(previous_bundle_filename, records)
+        print(f"{len(reused)} attachments reused from previous bundle")
+    to_fetch = [r for r in records if r["id"] not in reused]
+
+    # Attachments are streamed into the zip file as they are downloaded.
+    args_list = [(attachments_cache, base_url, r) for r in to_fetch]
+    all_attachments = iter_parallel(
+        get_attachment, args_list, host=urllib.parse.urlparse(base_url).netloc
+    )
+    # Members dates are the ones of their record, so that a bundle rebuilt from the
+    # same records is identical to the published one (and not uploaded again).
+    dates = {r["id"]: zip_date_time(r.get("last_modified", 0)) for r in records}
+    write_zip(
+        filename,
+        itertools.chain(
+            (
+                (f"{record['id']}.meta.json", meta, dates[record["id"]])
+                for record, meta in zip(records, metas)
+            ),
+            (
+                (record["id"], attachment, dates[record["id"]])
+                for record, attachment in zip(to_fetch, all_attachments)
+            ),
+        ),
+        reused_from=previous_bundle_filename,
+        reused_members=reused,
+        # Deflating images or compressed files costs CPU time, for almost no size gain.
+        stored_members={r["id"] for r in to_fetch if is_precompressed(r["attachment"])},
+        compresslevel=compresslevel,
+        workers=ZIP_COMPRESSION_WORKERS,
+    )
+    return filename
+
+
+class BundlesPipeline:
+    """
+    Build bundles in background workers, and upload each of them as soon as it
+    is ready, while the next ones are still being built.
+    At most as many builds as workers are queued, so that the records of only a
+    few collections are held at a time.
+    """
+
+    def __init__(self, workers: int, upload=None):
+        self.builders = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.uploader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.upload = upload
+        self.builds = []
+        self.uploads = []
+        self._slots = threading.BoundedSemaphore(2 * workers)
+
+    def submit(self, build, *args):
+        # Block until a build is done if too many are running or queued.
+        self._slots.acquire()
+        try:
+            self.builds.append(self.builders.submit(self._build_then_upload, build, args))
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _build_then_upload(self, build, args):
+        try:
+            filename = build(*args)
+        finally:
+            self._slots.release()
+        if self.upload is not None:
+            self.uploads.append(self.uploader.submit(self.upload, [filename]))
+        return filename
+
+    def wait(self) -> tuple[list[str], list[Exception]]:
+        """
+        Wait for all builds and uploads to complete. Return the list of built bundles,
+        and the list of bundles errors.
+        Unexpected errors are raised once the started builds and uploads are done.
+        """
+        built = []
+        errors = []
+        try:
+            for future in self.builds:
+                try:
+                    built.append(future.result())
+                except AttachmentIntegrityError as e:
+                    # Never publish a bundle with corrupted attachments.
+                    print(f"Bundle could not be built: {e}")
+                    errors.append(e)
+        finally:
+            # Builds that haven't started yet are cancelled if one of them failed.
+            self.builders.shutdown(cancel_futures=True)
+            self.uploader.shutdown()
+        for future in self.uploads:
+            future.result()
+        return built, errors
 
 
 def build_bundles(event, context):
@@ -135,18 +1096,37 @@ def build_bundles(event, context):
     Main command entry point that:
     - fetches all collections changesets
     - builds a `changesets.json.mozlz4`
-    - builds a `startup.json.mozlz4`
+    - builds a `startup.json.mozlz4` (and other bundles defined in `MOZLZ4_BUNDLES`)
     - fetches attachments of all collections with bundle flag
     - builds `{bid}--{cid}.zip` for each of them
     - send the bundles to the Cloud storage bucket
     """
     rs_server = event.get("server") or SERVER
+    bundles_definitions = parse_bundles_definitions(event.get("mozlz4_bundles") or MOZLZ4_BUNDLES)
 
     client = KintoClient(server_url=rs_server)
 
-    base_url = client.server_info()["capabilities"]["attachments"]["base_url"]
+    base_url = server_info_cache.server_info(client)["capabilities"]["attachments"]["base_url"]
 
-    all_changesets = fetch_all_changesets(client)
+    changesets_cache = (
+        ChangesetsCache(create_file_storage(CHANGESETS_CACHE_URL))
+        if CHANGESETS_CACHE_URL
+        else None
+    )
+    all_changesets = fetch_all_changesets(client, changesets_cache)
+
+    # Select the changesets of the mozlz4 bundles, in one pass over all collections.
+    selected_changesets, latest_timestamps = select_bundles_changesets(
+        bundles_definitions, all_changesets
+    )
+    # The records of collections that are part of no bundle (eg. most preview
+    # collections) are not kept in memory during the whole run.
+    in_mozlz4_bundles = {id(c) for changesets in selected_changesets.values() for c in changesets}
+    for changeset in all_changesets:
+        if id(changeset) not in in_mozlz4_bundles and not (
+            BUILD_ALL or changeset["metadata"].get("attachment", {}).get("bundle", False)
+        ):
+            changeset["changes"] = RawRecords()
 
     # Build all archives in temp directory.
     tmp_dir = tempfile.mkdtemp()
@@ -154,6 +1134,52 @@ def build_bundles(event, context):
 
     bundles_to_upload = []
     bundles_to_delete = []
+    errors = []
+
+    attachments_cache = (
+        AttachmentsCache(ATTACHMENTS_CACHE_DIR, ATTACHMENTS_CACHE_MAX_SIZE_BYTES)
+        if ATTACHMENTS_CACHE_MAX_SIZE_BYTES > 0
+        else None
+    )
+
+    pipeline = None
+    if BUNDLES_PIPELINE_WORKERS > 0:
+        upload = (
+            None
+            if SKIP_UPLOAD
+            else functools.partial(
+                sync_cloud_storage, STORAGE_BUCKET_NAME, DESTINATION_FOLDER, to_delete=[]
+            )
+        )
+        pipeline = BundlesPipeline(BUNDLES_PIPELINE_WORKERS, upload)
+        # Each worker downloads up to `PARALLEL_REQUESTS` attachments at once.
+        resize_http_session_pool(http_session, BUNDLES_PIPELINE_WORKERS * PARALLEL_REQUESTS)
+
+    # Look up the publication dates of all the bundles that may be rebuilt at once.
+    published_timestamps = get_published_timestamps(
+        base_url,
+        [
+            f"{c['metadata']['bucket']}--{c['metadata']['id']}.zip"
+            for c in all_changesets
+            if BUILD_ALL or c["metadata"].get("attachment", {}).get("bundle", False)
+        ]
+        + [definition["name"] for definition in bundles_definitions],
+    )
+    # Bundles whose rebuilt content was identical to the published one are not uploaded
+    # again, hence their publication date can be older than the changes they contain.
+    bundles_timestamps = fetch_json(
+        f"{base_url}{DESTINATION_FOLDER}/{BUNDLES_TIMESTAMPS_MANIFEST}", default={}
+    )
+
+    def bundle_timestamp(filename):
+        published = published_timestamps[filename]
+        if published < 0:
+            return published
+        return max(published, bundles_timestamps.get(filename, -1))
+
+    # Source timestamps of the bundles built in this run.
+    built_timestamps = {}
+    pipelined_timestamps = {}
 
     # Build attachments bundle for collections which have the option set.
     for changeset in all_changesets:
@@ -169,18 +1195,26 @@ def build_bundles(event, context):
         else:
             print(f"{bid}/{cid} has attachments bundles enabled")
 
-        existing_bundle_timestamp = get_modified_timestamp(
-            f"{base_url}{DESTINATION_FOLDER}/{bid}--{cid}.zip"
-        )
+        existing_bundle_timestamp = bundle_timestamp(attachments_bundle_filename)
         print(f"'{bid}--{cid}.zip' was modified at {existing_bundle_timestamp}")
         print(f"Latest change on {bid}/{cid} was at {changeset['timestamp']}")
-        if not BUILD_ALL and changeset["timestamp"] < existing_bundle_timestamp:
+        if not BUILD_ALL and changeset["timestamp"] <= existing_bundle_timestamp:
             # Collection hasn't changed since last bundling.
             print(f"{bid}/{cid} hasn't changed since last bundle.")
             continue
 
         # Skip bundle if no attachments found.
-        records = [r for r in changeset["changes"] if "attachment" in r]
+        changes = changeset["changes"]
+        records, metas = [], []
+        for i, record in enumerate(changes):
+            if "attachment" in record:
+                records.append(record)
+                # Compact records are already serialized.
+                metas.append(
+                    changes.raw(i)
+                    if isinstance(changes, RawRecords)
+                    else json.dumps(record).encode("utf-8")
+                )
         if not records:
             print(f"{bid}/{cid} has no attachments")
             bundles_to_delete.append(attachments_bundle_filename)
@@ -197,56 +1231,75 @@ def build_bundles(event, context):
         print(f"Attachments total size {total_size_mb:.2f}MB")
 
         # Fetch all attachments and build "{bid}--{cid}.zip"
-        args_list = [(f"{base_url}{r['attachment']['location']}",) for r in records]
-        all_attachments = call_parallel(fetch_attachment, args_list)
-        write_zip(
+        build_args = (
+            base_url,
+            attachments_cache,
             attachments_bundle_filename,
-            [(f"{record['id']}.meta.json", json.dumps(record)) for record in records]
-            + [(record["id"], attachment) for record, attachment in zip(records, all_attachments)],
+            records,
+            existing_bundle_timestamp,
+            metas,
+            bundle_compresslevel(bid, cid),
         )
+        if pipeline is not None:
+            pipeline.submit(build_attachments_bundle, *build_args)
+            pipelined_timestamps[attachments_bundle_filename] = changeset["timestamp"]
+            continue
+        try:
+            build_attachments_bundle(*build_args)
+        except AttachmentIntegrityError as e:
+            # Never publish a bundle with corrupted attachments.
+            print(f"{bid}/{cid} bundle could not be built: {e}")
+            errors.append(e)
+            continue
         bundles_to_upload.append(attachments_bundle_filename)
+        built_timestamps[attachments_bundle_filename] = changeset["timestamp"]
 
     highest_timestamp = max(c["timestamp"] for c in all_changesets)
     print(f"Latest server change was at {highest_timestamp}")
 
-    existing_bundle_timestamp = get_modified_timestamp(
-        f"{base_url}{DESTINATION_FOLDER}/changesets.json.mozlz4"
-    )
-    print(f"'changesets.json.mozlz4' was published at {existing_bundle_timestamp}")
-    if BUILD_ALL or (existing_bundle_timestamp < highest_timestamp):
-        write_json_mozlz4(
-            "changesets.json.mozlz4",
-            [
-                changeset
-                for changeset in all_changesets
-                if "preview" not in changeset["metadata"]["bucket"]
-            ],
-        )
-        bundles_to_upload.append("changesets.json.mozlz4")
-    else:
-        print("Existing 'changesets.json.mozlz4' bundle up-to-date. Nothing to do.")
+    # Build the mozlz4 bundles of changesets.
+    for definition in bundles_definitions:
+        bundle_file = definition["name"]
+        existing_bundle_timestamp = bundle_timestamp(bundle_file)
+        print(f"{bundle_file!r} was published at {existing_bundle_timestamp}")
+        if BUILD_ALL or existing_bundle_timestamp < latest_timestamps[bundle_file]:
+            if CHANGESETS_DELTAS and bundle_file == "changesets.json.mozlz4":
+                # Allow clients with the previous snapshot to only download the changes.
+                delta_to_upload, delta_to_delete = build_changesets_delta(
+                    base_url, bundle_file, selected_changesets[bundle_file]
+                )
+                bundles_to_upload.extend(delta_to_upload)
+                bundles_to_delete.extend(delta_to_delete)
+            write_json_mozlz4(bundle_file, selected_changesets[bundle_file])
+            bundles_to_upload.append(bundle_file)
+            built_timestamps[bundle_file] = latest_timestamps[bundle_file]
+        else:
+            print(f"Existing {bundle_file!r} bundle up-to-date. Nothing to do.")
 
-    # Build a bundle for collections that are marked with "startup" flag.
-    startup_file = "startup.json.mozlz4"
-    existing_bundle_timestamp = get_modified_timestamp(
-        f"{base_url}{DESTINATION_FOLDER}/{startup_file}"
-    )
-    print(f"{startup_file!r} was published at {existing_bundle_timestamp}")
-    if BUILD_ALL or existing_bundle_timestamp < highest_timestamp:
-        write_json_mozlz4(
-            startup_file,
-            [
-                changeset
-                for changeset in all_changesets
-                if "startup" in changeset["metadata"].get("flags", [])
-                and "preview" not in changeset["metadata"]["bucket"]
-            ],
-        )
-        bundles_to_upload.append(startup_file)
-    else:
-        print(f"Existing {startup_file!r} bundle up-to-date. Nothing to do.")
+    if pipeline is not None:
+        # Wait for the attachments bundles built and uploaded in the background.
+        built, pipeline_errors = pipeline.wait()
+        errors.extend(pipeline_errors)
+        built_timestamps.update({filename: pipelined_timestamps[filename] for filename in built})
 
     if not SKIP_UPLOAD:
         sync_cloud_storage(
             STORAGE_BUCKET_NAME, DESTINATION_FOLDER, bundles_to_upload, bundles_to_delete
         )
+        if built_timestamps:
+            timestamps_manifest = {
+                filename: timestamp
+                for filename, timestamp in bundles_timestamps.items()
+                if filename not in bundles_to_delete
+            }
+            timestamps_manifest.update(built_timestamps)
+            with open(BUNDLES_TIMESTAMPS_MANIFEST, "w") as f:
+                json.dump(timestamps_manifest, f, sort_keys=True)
+            # Only once the bundles it refers to are published.
+            sync_cloud_storage(
+                STORAGE_BUCKET_NAME, DESTINATION_FOLDER, [BUNDLES_TIMESTAMPS_MANIFEST], []
+            )
+
+    if errors:
+        error_messages = [str(e) for e in errors]
+        raise BundleError("\n" + "\n\n".join(error_messages))
@@ -1,11 +1,21 @@
+import hashlib
 import os
+import urllib.parse
 from datetime import datetime, timezone
 
-from kinto_http import KintoException
+import requests
+from decouple import strtobool
+from kinto_http import KintoBatchException, KintoException
 
+from . import DRY_MODE, call_parallel, server_info_cache
 from . import KintoClient as Client
 
 
+# The server signs each collection of a batch request before responding, hence batches
+# are kept small enough to be answered within the requests timeout.
+REFRESH_SIGNATURE_BATCH_SIZE = int(os.getenv("REFRESH_SIGNATURE_BATCH_SIZE", 5))
+
+
 class RefreshError(Exception):
     pass
 
@@ -19,22 +29,159 @@ def utcnow():
     return datetime.now(timezone.utc)
 
 
-def get_signed_source(server_info, change):
+def get_signed_source(signer_index, change):
     # Small helper to identify the source collection from a potential
     # signing destination collection, like those mentioned in the changes endpoint
     # (eg. blocklists/plugins -> staging/plugins).
-    signed_resources = server_info["capabilities"]["signer"]["resources"]
-    for r in signed_resources:
-        match_destination = r["destination"]["bucket"] == change["bucket"] and (
-            r["destination"]["collection"] is None
-            or r["destination"]["collection"] == change["collection"]
+    r = signer_index.by_destination(change["bucket"], change["collection"])
+    if r is None:
+        return None
+    return {
+        "bucket": r["source"]["bucket"],
+        # Per-bucket configuration.
+        "collection": r["source"]["collection"] or change["collection"],
+    }
+
+
+def signature_age(collection_metadata):
+    """
+    Return the age in days of the collection signature, or ``None`` if it was never signed.
+    """
+    last_signature_date = collection_metadata.get("last_signature_date")
+    if not last_signature_date:
+        return None
+    last_signature_dt = datetime.fromisoformat(last_signature_date)
+    return (utcnow() - last_signature_dt).days
+
+
+def stagger_slot(source, nb_slots):
+    """
+    Return the run slot of the `source` collection, between 0 and `nb_slots` - 1.
+    It is derived from a hash of its name, hence it is the same on every run.
+    """
+    name = "%s/%s" % (source["bucket"], source["collection"])
+    digest = hashlib.sha256(name.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % nb_slots
+
+
+def schedule_refresh(candidates, max_signature_age, budget=0, nb_slots=0, run_index=0):
+    """
+    Return the collections to refresh in this run, and the postponed ones, from
+    the `candidates` list of ``(source, signature age)``.
+
+    Collections signed more than `max_signature_age` days ago are due. When staggering
+    is enabled (with `nb_slots`), collections are also refreshed early during the run
+    of their slot, so that signatures created at the same time don't all expire together.
+    At most `budget` collections are refreshed per run (if specified), the oldest first.
+    """
+    due = []
+    for source, age in candidates:
+        age = float("inf") if age is None else age
+        if age >= max_signature_age:
+            due.append((age, source))
+        elif nb_slots and age >= 1 and stagger_slot(source, nb_slots) == run_index % nb_slots:
+            due.append((age, source))
+    due.sort(key=lambda d: d[0], reverse=True)
+    if budget:
+        return [source for _, source in due[:budget]], [source for _, source in due[budget:]]
+    return [source for _, source in due], []
+
+
+def project_refresh_load(
+    candidates, max_signature_age, budget=0, nb_slots=0, run_index=0, interval_days=1
+):
+    """
+    Return the projected number of collections refreshed on each of the next runs,
+    for as many runs as it takes for a signature to become due.
+    """
+    ages = {(s["bucket"], s["collection"]): (s, age) for s, age in candidates}
+    loads = []
+    nb_runs = max(1, -(-max_signature_age // interval_days)) + 1
+    for i in range(nb_runs):
+        refreshed, _ = schedule_refresh(
+            ages.values(), max_signature_age, budget, nb_slots, run_index + i
         )
-        if match_destination:
-            return {
-                "bucket": r["source"]["bucket"],
-                # Per-bucket configuration.
-                "collection": r["source"]["collection"] or change["collection"],
-            }
+        loads.append(len(refreshed))
+        for source in refreshed:
+            ages[(source["bucket"], source["collection"])] = (source, 0)
+        ages = {
+            key: (source, None if age is None else age + interval_days)
+            for key, (source, age) in ages.items()
+        }
+    return loads
+
+
+def get_collections_metadata(client, buckets):
+    """
+    Return the metadata of all the collections of the specified `buckets`, with
+    one (paginated) listing per bucket, along with the errors of each bucket.
+    """
+
+    def list_collections(bid):
+        try:
+            return client.get_collections(bucket=bid), None
+        except (KintoException, requests.exceptions.RequestException) as e:
+            return [], e
+
+    results = call_parallel(
+        list_collections,
+        [(bid,) for bid in buckets],
+        host=urllib.parse.urlparse(client.session.server_url).netloc,
+    )
+    metadata = {}
+    errors = {}
+    for bid, (collections, error) in zip(buckets, results):
+        if error is not None:
+            print("%s: %s" % (bid, error))
+            errors[bid] = error
+        for collection_metadata in collections:
+            metadata[(bid, collection_metadata["id"])] = collection_metadata
+    return metadata, errors
+
+
+def request_resign(client, sources, batch_size):
+    """
+    Mark the `sources` collections to be signed again, in batch requests of
+    `batch_size`. Return the errors.
+    """
+    errors = []
+    for i in range(0, len(sources), batch_size):
+        errors.extend(_request_resign_batch(client, sources[i : i + batch_size]))
+    return errors
+
+
+def _request_resign_batch(client, sources):
+    try:
+        with client.batch() as batch:
+            for source in sources:
+                batch.patch_collection(
+                    id=source["collection"], bucket=source["bucket"], data={"status": "to-resign"}
+                )
+    except KintoBatchException as e:
+        # Some of the requests failed.
+        responses = [r for resp, _ in e.results for r in resp["responses"]]
+        errors = e.exceptions
+    except (KintoException, requests.exceptions.RequestException) as e:
+        # A server or network error interrupted the batch.
+        print("Batch of %s refreshes failed: %s" % (len(sources), e))
+        return [e]
+    else:
+        responses = [{"status": 200, "body": body} for body in batch.results()]
+        errors = []
+
+    for source, response in zip(sources, responses):
+        if 200 <= response["status"] < 400:
+            last_modified = response["body"]["data"]["last_modified"]
+            print(
+                "%s/%s: Refresh signature: at %s ( %s )"
+                % (
+                    source["bucket"],
+                    source["collection"],
+                    timestamp_to_date(last_modified),
+                    last_modified,
+                )
+            )
+    return errors
 
 
 def refresh_signature(event, context, **kwargs):
@@ -42,6 +189,12 @@ def refresh_signature(event, context, **kwargs):
     server_url = event["server"]
     auth = event.get("refresh_signature_auth") or os.getenv("REFRESH_SIGNATURE_AUTH")
     max_signature_age = int(event.get("max_signature_age", os.getenv("MAX_SIGNATURE_AGE", 7)))
+    # Spread the signatures refresh across runs, with at most `budget` collections per run.
+    budget = int(event.get("refresh_budget", os.getenv("REFRESH_SIGNATURE_BUDGET", 0)))
+    stagger = strtobool(str(event.get("stagger", os.getenv("STAGGER_SIGNATURE_REFRESH", "0"))))
+    interval_days = int(
+        event.get("refresh_interval_days", os.getenv("REFRESH_SIGNATURE_INTERVAL_DAYS", 1))
+    )
 
     # Look at the collections in the changes endpoint.
     bucket = event.get("bucket", "monitor")
@@ -51,53 +204,56 @@ def refresh_signature(event, context, **kwargs):
     changes = client.get_records()
 
     # Look at the signer configuration on the server.
-    server_info = client.server_info()
-
-    errors = []
-
-    for change in changes:
-        # 0. Figure out which was the source collection of this signed collection.
-        source = get_signed_source(server_info, change)
-        if source is None:
-            # Skip if change is no kinto-signer destination (eg. review collection)
-            continue
+    signer_index = server_info_cache.signer_index(client)
 
-        client = Client(
-            server_url=server_url,
-            bucket=source["bucket"],
-            collection=source["collection"],
-            auth=auth,
-        )
+    # Figure out which was the source collection of each signed collection.
+    # Changes that are no kinto-signer destination (eg. review collection) are skipped.
+    sources = [source for change in changes if (source := get_signed_source(signer_index, change))]
 
-        try:
-            print("Looking at %s:" % client.get_endpoint("collection"), end=" ")
+    # Grab the information of all source collections at once.
+    client = Client(server_url=server_url, auth=auth)
+    buckets = sorted({source["bucket"] for source in sources})
+    collections_metadata, bucket_errors = get_collections_metadata(client, buckets)
 
-            # 1. Grab collection information
-            collection_metadata = client.get_collection()["data"]
-            last_modified = collection_metadata["last_modified"]
-            status = collection_metadata.get("status")
-            last_signature_date = collection_metadata.get("last_signature_date")
+    errors = []
+    candidates = []
+    for source in sources:
+        bid, cid = source["bucket"], source["collection"]
+        if bid in bucket_errors:
+            # Reported once for the whole bucket.
+            continue
+        collection_metadata = collections_metadata.get((bid, cid))
+        if collection_metadata is None:
+            print("%s/%s: not found" % (bid, cid))
+            errors.append(KintoException("Collection %s/%s not found" % (bid, cid)))
+            continue
+        candidates.append((source, signature_age(collection_metadata)))
+    errors.extend(bucket_errors.values())
 
+    # Each slot is one run, and there are as many as runs within the max signature age.
+    nb_slots = max(1, max_signature_age // interval_days) if stagger else 0
+    run_index = utcnow().toordinal() // interval_days
+    to_refresh, postponed = schedule_refresh(
+        candidates, max_signature_age, budget, nb_slots, run_index
+    )
+    scheduled = {(s["bucket"], s["collection"]) for s in to_refresh + postponed}
+    for source, age in candidates:
+        if (source["bucket"], source["collection"]) not in scheduled:
             # Skip signature refresh if the collection was signed recently.
-            if last_signature_date:
-                last_signature_dt = datetime.fromisoformat(last_signature_date)
-                last_signature_age = (utcnow() - last_signature_dt).days
-                if last_signature_age < max_signature_age:
-                    print("SKIP (only %s days old)" % last_signature_age)
-                    continue
-
-            # 2. Refresh!
-            print("Refresh signature: ", end="")
-            new_metadata = client.patch_collection(data={"status": "to-resign"})
-            last_modified = new_metadata["data"]["last_modified"]
-
-            # 3. Display the status of the collection
-            last_modified_dt = timestamp_to_date(last_modified)
-            print("status=", status, "at", last_modified_dt, "(", last_modified, ")")
-
-        except KintoException as e:
-            print(e)
-            errors.append(e)
+            print("%s/%s: SKIP (only %s days old)" % (source["bucket"], source["collection"], age))
+    for source in postponed:
+        print("%s/%s: POSTPONED (over budget)" % (source["bucket"], source["collection"]))
+
+    if DRY_MODE:
+        loads = project_refresh_load(
+            candidates, max_signature_age, budget, nb_slots, run_index, interval_days
+        )
+        print("Projected signatures refreshes on the next runs: %s" % loads)
+        for source in to_refresh:
+            print("%s/%s: would refresh signature" % (source["bucket"], source["collection"]))
+    elif to_refresh:
+        # Refresh!
+        errors.extend(request_resign(client, to_refresh, REFRESH_SIGNATURE_BATCH_SIZE))
 
     if len(errors) > 0:
         error_messages = [str(e) for e in errors]
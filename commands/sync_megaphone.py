@@ -3,7 +3,7 @@ import os
 
 import requests.auth
 
-from . import KintoClient
+from . import KintoClient, http_session
 
 
 logger = logging.getLogger(__name__)
@@ -34,7 +34,7 @@ class Megaphone:
 
     def send_version(self, version):
         url = f"{self.url}/broadcasts/{self.broadcaster_id}"
-        resp = requests.put(url, auth=self.broadcaster_auth, data=version)
+        resp = http_session.put(url, auth=self.broadcaster_auth, data=version)
         resp.raise_for_status()
         logger.info(
             "Sent version {} to megaphone. Response was {}".format(version, resp.status_code)
@@ -42,7 +42,7 @@ class Megaphone:
 
     def get_version(self):
         url = f"{self.url}/broadcasts"
-        resp = requests.get(url, auth=self.reader_auth)
+        resp = http_session.get(url, auth=self.reader_auth)
         resp.raise_for_status()
         broadcasts = resp.json()
         etag = broadcasts["broadcasts"][self.broadcaster_id]
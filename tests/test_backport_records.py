@@ -1,10 +1,26 @@
+import collections
 import json
+import os
+import tempfile
+import time
 import unittest
 
 import pytest
+import requests
 import responses
+from kinto_http import KintoException
 
-from commands.backport_records import backport_records
+from commands import KintoClient, ServerInfoCache, SignerIndex, server_info_cache
+from commands.backport_records import (
+    BackportError,
+    SourcesRecords,
+    apply_changes,
+    backport_records,
+    filter_records,
+    read_cursors,
+    sources_key,
+    write_cursors,
+)
 
 
 class TestRecordsBackport(unittest.TestCase):
@@ -254,7 +270,7 @@ class TestRecordsBackport(unittest.TestCase):
             context=None,
         )
 
-        assert len(responses.calls) == 6
+        assert len(responses.calls) == 5
         assert responses.calls[0].request.method == "GET"
         assert responses.calls[0].request.url.endswith(self.source_records_uri)
         assert responses.calls[1].request.method == "GET"
@@ -262,18 +278,215 @@ class TestRecordsBackport(unittest.TestCase):
         # Check if the destination collection is signed.
         assert responses.calls[2].request.method == "GET"
         assert responses.calls[2].request.url.endswith(self.dest_collection_uri)
-        # Fetch server info for batch requests size.
+        # Fetch server info for batch requests size, and check if the
+        # destination has review enabled.
         assert responses.calls[3].request.method == "GET"
         assert responses.calls[3].request.url == self.server + "/"
-        # Check if the destination has review enabled.
-        assert responses.calls[4].request.method == "GET"
-        assert responses.calls[4].request.url == self.server + "/"
         # Request signing.
-        assert responses.calls[5].request.method == "PATCH"
-        assert responses.calls[5].request.url.endswith(self.dest_collection_uri)
-        sign_request = json.loads(responses.calls[5].request.body)
+        assert responses.calls[4].request.method == "PATCH"
+        assert responses.calls[4].request.url.endswith(self.dest_collection_uri)
+        sign_request = json.loads(responses.calls[4].request.body)
         assert sign_request == {"data": {"status": "to-sign"}}
 
+    def event_with_cursors(self, cursors):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cursors_path = os.path.join(tmp_dir.name, "cursors.json")
+        with open(self.cursors_path, "w") as f:
+            json.dump(cursors, f)
+        return {
+            "server": self.server,
+            "backport_records_source_auth": self.auth,
+            "backport_records_source_bucket": self.source_bid,
+            "backport_records_source_collection": self.source_cid,
+            "backport_records_source_filters": '{"country": "fr"}',
+            "backport_records_dest_bucket": self.dest_bid,
+            "backport_records_dest_collection": self.dest_cid,
+            "backport_records_cursors_url": self.cursors_path,
+        }
+
+    def read_cursors(self):
+        with open(self.cursors_path) as f:
+            return json.load(f)
+
+    def mock_timestamps(self, source, dest):
+        responses.add(responses.HEAD, self.source_records_uri, headers={"ETag": f'"{source}"'})
+        responses.add(responses.HEAD, self.dest_records_uri, headers={"ETag": f'"{dest}"'})
+
+    def records_calls(self):
+        return [c for c in responses.calls if c.request.method != "HEAD"]
+
+    @responses.activate
+    def test_incremental_backport(self):
+        key = "main/one?country=fr -> main-workspace/other"
+        event = self.event_with_cursors(
+            {key: {"since": "42", "dest": "30", "full_sync": time.time()}}
+        )
+        self.mock_timestamps(source=50, dest=30)
+        responses.add(
+            responses.GET,
+            self.server + "/",
+            json={"settings": {"batch_max_requests": 10}, "capabilities": {}},
+        )
+        responses.add(
+            responses.GET,
+            self.source_records_uri,
+            json={
+                "data": [
+                    {"id": "a", "country": "fr", "last_modified": 50},
+                    {"id": "b", "country": "de", "last_modified": 49},
+                    {"id": "c", "deleted": True, "last_modified": 48},
+                ]
+            },
+            headers={"ETag": '"50"'},
+        )
+        responses.add(
+            responses.GET,
+            self.dest_records_uri,
+            json={
+                "data": [
+                    {"id": "b", "country": "fr", "last_modified": 20},
+                    {"id": "c", "country": "fr", "last_modified": 10},
+                ]
+            },
+            headers={"ETag": '"30"'},
+        )
+        responses.add(
+            responses.POST,
+            self.server + "/batch",
+            json={
+                "responses": [
+                    {"status": 201, "body": {"data": {"id": "a", "last_modified": 61}}},
+                    {"status": 200, "body": {"data": {"id": "b", "last_modified": 62}}},
+                    {"status": 200, "body": {"data": {"id": "c", "last_modified": 63}}},
+                ]
+            },
+        )
+
+        backport_records(event=event, context=None)
+
+        # Only the changes since the cursor are read, and filtered locally.
+        calls = self.records_calls()
+        assert calls[0].request.params == {"_since": "42"}
+        assert calls[1].request.params == {"in_id": "a,b,c"}
+        batch = json.loads(calls[3].request.body)
+        assert [(r["method"], r["path"].split("/")[-1]) for r in batch["requests"]] == [
+            ("PUT", "a"),
+            ("DELETE", "b"),
+            ("DELETE", "c"),
+        ]
+        cursor = self.read_cursors()[key]
+        assert cursor["since"] == "50"
+        # Our own changes are part of the high-water mark.
+        assert cursor["dest"] == "63"
+
+    @responses.activate
+    def test_nothing_moved_since_last_sync(self):
+        key = "main/one?country=fr -> main-workspace/other"
+        full_sync = time.time()
+        event = self.event_with_cursors(
+            {key: {"since": "42", "dest": "30", "full_sync": full_sync}}
+        )
+        self.mock_timestamps(source=42, dest=30)
+        responses.add(responses.GET, self.dest_collection_uri, json={"data": {"status": "signed"}})
+
+        backport_records(event=event, context=None)
+
+        # No records are downloaded, only the destination status is checked.
+        assert [c.request.url for c in self.records_calls()] == [self.dest_collection_uri]
+        assert self.read_cursors()[key] == {"since": "42", "dest": "30", "full_sync": full_sync}
+
+    @responses.activate
+    def test_nothing_moved_but_full_sync_is_due(self):
+        key = "main/one?country=fr -> main-workspace/other"
+        event = self.event_with_cursors({key: {"since": "42", "dest": "30", "full_sync": 0}})
+        self.mock_timestamps(source=42, dest=30)
+        responses.add(
+            responses.GET,
+            self.source_records_uri,
+            json={"data": [{"id": "a", "country": "fr", "last_modified": 40}]},
+        )
+        responses.add(
+            responses.GET,
+            self.dest_records_uri,
+            json={"data": [{"id": "a", "country": "fr", "last_modified": 30}]},
+            headers={"ETag": '"30"'},
+        )
+        responses.add(responses.GET, self.dest_collection_uri, json={"data": {"status": "signed"}})
+
+        backport_records(event=event, context=None)
+
+        # The whole collections are compared, to fix any drift.
+        assert self.records_calls()[0].request.params == {"country": "fr"}
+        assert time.time() - self.read_cursors()[key]["full_sync"] < 60
+
+    @responses.activate
+    def test_destination_changes_trigger_full_sync(self):
+        key = "main/one?country=fr -> main-workspace/other"
+        event = self.event_with_cursors(
+            {key: {"since": "42", "dest": "30", "full_sync": time.time()}}
+        )
+        self.mock_timestamps(source=42, dest=35)
+        responses.add(
+            responses.GET,
+            self.source_records_uri,
+            json={"data": [{"id": "a", "country": "fr", "last_modified": 40}]},
+        )
+        responses.add(
+            responses.GET,
+            self.dest_records_uri,
+            json={"data": [{"id": "a", "country": "fr", "last_modified": 35}]},
+            headers={"ETag": '"35"'},
+        )
+        responses.add(responses.GET, self.dest_collection_uri, json={"data": {"status": "signed"}})
+
+        backport_records(event=event, context=None)
+
+        assert self.records_calls()[0].request.params == {"country": "fr"}
+        cursor = self.read_cursors()[key]
+        assert cursor["dest"] == "35"
+        assert time.time() - cursor["full_sync"] < 60
+
+    @responses.activate
+    def test_periodic_full_sync(self):
+        key = "main/one?country=fr -> main-workspace/other"
+        event = self.event_with_cursors({key: {"since": "42", "dest": "30", "full_sync": 0}})
+        self.mock_timestamps(source=60, dest=30)
+        responses.add(
+            responses.GET,
+            self.source_records_uri,
+            json={"data": [{"id": "a", "country": "fr", "last_modified": 50}]},
+        )
+        responses.add(
+            responses.GET,
+            self.dest_records_uri,
+            json={"data": [{"id": "a", "country": "fr", "last_modified": 20}]},
+            headers={"ETag": '"30"'},
+        )
+        responses.add(responses.GET, self.dest_collection_uri, json={"data": {"status": "signed"}})
+
+        backport_records(event=event, context=None)
+
+        assert self.records_calls()[0].request.params == {"country": "fr"}
+        cursor = self.read_cursors()[key]
+        # The source timestamp read before the records.
+        assert cursor["since"] == "60"
+        assert time.time() - cursor["full_sync"] < 60
+
+    @responses.activate
+    def test_failed_mapping_keeps_its_cursor(self):
+        key = "main/one?country=fr -> main-workspace/other"
+        event = self.event_with_cursors(
+            {key: {"since": "42", "dest": "30", "full_sync": time.time()}}
+        )
+        self.mock_timestamps(source=50, dest=30)
+        responses.add(responses.GET, self.source_records_uri, status=403, json={})
+
+        with pytest.raises(BackportError):
+            backport_records(event=event, context=None)
+
+        assert self.read_cursors()[key]["since"] == "42"
+
 
 @pytest.mark.parametrize(
     "mapping_env, expected_calls",
@@ -293,7 +506,13 @@ class TestRecordsBackport(unittest.TestCase):
     ],
 )
 def test_correct_multiline_mappings(mapping_env, expected_calls):
-    with unittest.mock.patch("commands.backport_records.execute_backport") as mocked:
+    with (
+        unittest.mock.patch("commands.backport_records.execute_backport") as mocked,
+        unittest.mock.patch(
+            "commands.backport_records.SourcesRecords",
+            return_value=collections.defaultdict(list),
+        ),
+    ):
         backport_records(
             event={
                 "server": "http://server",
@@ -309,6 +528,7 @@ def test_correct_multiline_mappings(mapping_env, expected_calls):
                 unittest.mock.ANY,
                 unittest.mock.ANY,
                 *expected_params,
+                source_records=unittest.mock.ANY,
             )
 
 
@@ -330,3 +550,314 @@ def test_incorrect_multiline_mappings(mapping_env):
                 },
                 context=None,
             )
+
+
+@pytest.mark.parametrize(
+    "filters, expected_ids",
+    [
+        ({}, ["a", "b", "c"]),
+        ({"country": "fr"}, ["a"]),
+        ({"age": "22"}, ["b"]),
+        ({"eq_age": "22"}, ["b"]),
+        ({"not_country": "fr"}, ["b", "c"]),
+        ({"in_country": "fr,de"}, ["a", "b"]),
+        ({"exclude_country": "fr,de"}, ["c"]),
+        ({"has_country": "true"}, ["a", "b"]),
+        ({"has_country": "false"}, ["c"]),
+        ({"meta.enabled": "true"}, ["a"]),
+        ({"country": "de", "age": "22"}, ["b"]),
+    ],
+)
+def test_filter_records(filters, expected_ids):
+    records = [
+        {"id": "a", "country": "fr", "age": 30, "meta": {"enabled": True}},
+        {"id": "b", "country": "de", "age": 22},
+        {"id": "c", "age": 18},
+    ]
+
+    assert [r["id"] for r in filter_records(records, filters)] == expected_ids
+
+
+@pytest.mark.parametrize(
+    "filters", [{"min_age": "20"}, {"_sort": "age"}, {"like_country": "f*"}, {"in_x": ["a"]}]
+)
+def test_filter_records_unsupported(filters):
+    assert filter_records([], filters) is None
+
+
+@responses.activate
+def test_shared_source_is_read_once():
+    server = "https://fake-server.net/v1"
+    responses.add(
+        responses.GET,
+        server + "/buckets/main/collections/one/records",
+        json={"data": [{"id": "a", "country": "fr"}, {"id": "b", "country": "de"}]},
+    )
+
+    with unittest.mock.patch("commands.backport_records.execute_backport") as mocked:
+        backport_records(
+            event={
+                "server": server,
+                "backport_records_source_auth": "admin:admin",
+                "backport_records_mappings": (
+                    "main/one?country=fr -> ws/fr\nmain/one?country=de -> ws/de"
+                ),
+            },
+            context=None,
+        )
+
+    assert len(responses.calls) == 1
+    by_dest = {c[0][8]: c[1]["source_records"] for c in mocked.call_args_list}
+    assert by_dest == {
+        "fr": [{"id": "a", "country": "fr"}],
+        "de": [{"id": "b", "country": "de"}],
+    }
+
+
+def test_read_and_write_cursors(tmp_path):
+    url = f"file://{tmp_path}/cursors.json"
+    assert read_cursors(url) == {}
+
+    write_cursors(url, {"a -> b": {"since": "42"}})
+
+    assert read_cursors(url) == {"a -> b": {"since": "42"}}
+    assert os.listdir(tmp_path) == ["cursors.json"]
+
+
+@responses.activate
+def test_sources_records_are_read_on_demand_and_released():
+    server = "https://fake-server.net/v1"
+    responses.add(
+        responses.GET,
+        server + "/buckets/main/collections/one/records",
+        json={"data": [{"id": "a", "country": "fr"}, {"id": "b", "country": "de"}]},
+    )
+    responses.add(
+        responses.GET, server + "/buckets/main/collections/two/records", json={"data": []}
+    )
+    mappings = [
+        ("main", "one", {"country": "fr"}, "ws", "fr"),
+        ("main", "one", {"country": "de"}, "ws", "de"),
+        ("main", "two", {}, "ws", "two"),
+    ]
+
+    sources_records = SourcesRecords(server, ("admin", "admin"), mappings)
+
+    # Nothing is read before it is needed.
+    assert len(responses.calls) == 0
+    assert sources_records[sources_key("main", "one", {"country": "fr"})] == [
+        {"id": "a", "country": "fr"}
+    ]
+    assert len(responses.calls) == 1
+    # Kept until the other mapping of the same source gets its records.
+    assert len(sources_records._results) == 1
+    assert sources_records[sources_key("main", "one", {"country": "de"})] == [
+        {"id": "b", "country": "de"}
+    ]
+    assert len(responses.calls) == 1
+    assert sources_records._results == {}
+
+
+def test_errors_are_reported_per_mapping():
+    def execute_backport(*args, source_records):
+        if args[-1] == "cid1":
+            raise KintoException("Unauthorized")
+
+    with (
+        unittest.mock.patch(
+            "commands.backport_records.execute_backport", side_effect=execute_backport
+        ) as mocked,
+        unittest.mock.patch(
+            "commands.backport_records.SourcesRecords",
+            return_value=collections.defaultdict(list),
+        ),
+    ):
+        with pytest.raises(BackportError) as exc_info:
+            backport_records(
+                event={
+                    "server": "http://server",
+                    "backport_records_source_auth": "admin:admin",
+                    "backport_records_mappings": "ws/scid1 -> main/cid1\nws/scid2 -> main/cid2",
+                },
+                context=None,
+            )
+
+    assert "ws/scid1 -> main/cid1: Unauthorized" in str(exc_info.value)
+    # The other mappings are executed anyway.
+    assert mocked.call_count == 2
+
+
+def test_network_errors_are_reported_per_mapping(tmp_path):
+    cursors_path = tmp_path / "cursors.json"
+    cursors_path.write_text("{}")
+
+    def execute_backport(*args, source_records):
+        if args[-1] == "cid1":
+            raise requests.exceptions.ConnectionError("Connection reset")
+        return ("42", "30")
+
+    with (
+        unittest.mock.patch(
+            "commands.backport_records.execute_backport", side_effect=execute_backport
+        ) as mocked,
+        unittest.mock.patch(
+            "commands.backport_records.SourcesRecords",
+            return_value=collections.defaultdict(list),
+        ),
+        unittest.mock.patch(
+            "commands.backport_records.read_timestamps",
+            return_value=collections.defaultdict(lambda: (None, None)),
+        ),
+    ):
+        with pytest.raises(BackportError) as exc_info:
+            backport_records(
+                event={
+                    "server": "http://server",
+                    "backport_records_source_auth": "admin:admin",
+                    "backport_records_mappings": "ws/scid1 -> main/cid1\nws/scid2 -> main/cid2",
+                    "backport_records_cursors_url": str(cursors_path),
+                },
+                context=None,
+            )
+
+    assert "ws/scid1 -> main/cid1: Connection reset" in str(exc_info.value)
+    assert mocked.call_count == 2
+    # The cursors of the mappings that succeeded are saved.
+    assert list(json.loads(cursors_path.read_text())) == ["ws/scid2 -> main/cid2"]
+
+
+@responses.activate
+def test_server_info_cache():
+    server = "https://fake-server.net/v1"
+    responses.add(
+        responses.GET,
+        server + "/",
+        json={"settings": {"batch_max_requests": 10}, "capabilities": {}},
+    )
+    responses.add(responses.POST, server + "/batch", json={"responses": []})
+    cache = ServerInfoCache(ttl_seconds=60)
+    client = KintoClient(server_url=server)
+    other_client = KintoClient(server_url=server, bucket="main", auth=("user", "pass"))
+
+    assert cache.server_info(client) == cache.server_info(other_client)
+    assert cache.signer_index(client) is cache.signer_index(other_client)
+    with other_client.batch() as batch:
+        batch.create_record(data={"id": "a"}, collection="cid")
+    # Fetched once for all clients, including the batch settings.
+    assert [c.request.method for c in responses.calls] == ["GET", "POST"]
+
+    with unittest.mock.patch("commands.time.monotonic", return_value=time.monotonic() + 61):
+        cache.server_info(client)
+    assert len(responses.calls) == 3
+
+
+def test_signer_index():
+    index = SignerIndex(
+        {
+            "capabilities": {
+                "signer": {
+                    "to_review_enabled": True,
+                    "resources": [
+                        {
+                            "source": {"bucket": "main-workspace", "collection": None},
+                            "destination": {"bucket": "main", "collection": None},
+                        },
+                        {
+                            "source": {"bucket": "main-workspace", "collection": "regions"},
+                            "destination": {"bucket": "main", "collection": "regions"},
+                            "to_review_enabled": False,
+                        },
+                    ],
+                }
+            }
+        }
+    )
+
+    assert index.config["to_review_enabled"]
+    assert index.by_source("main-workspace", "regions")["to_review_enabled"] is False
+    assert "to_review_enabled" not in index.by_source("main-workspace", "top-sites")
+    assert index.by_destination("main", "top-sites")["source"]["bucket"] == "main-workspace"
+    assert index.by_source("main", "regions") is None
+    assert SignerIndex({"capabilities": {}}).by_source("main", "regions") is None
+
+
+def batch_client(server):
+    responses.add(
+        responses.GET,
+        server + "/",
+        json={"settings": {"batch_max_requests": 10}, "capabilities": {}},
+    )
+    client = KintoClient(server_url=server, bucket="main", collection="cid", retry=0)
+    # Batch requests use the settings read along with the server info.
+    server_info_cache.server_info(client)
+    return client
+
+
+@responses.activate
+def test_apply_changes_in_parallel_chunks():
+    server = "https://fake-server.net/v1"
+    attempts = collections.Counter()
+
+    def batch(request):
+        requests = json.loads(request.body)["requests"]
+        ids = tuple(r["path"].split("/")[-1] for r in requests)
+        attempts[ids] += 1
+        if ids == ("c", "d") and attempts[ids] == 1:
+            return (500, {}, json.dumps({"message": "Boom"}))
+        body = {
+            "responses": [
+                {"status": 403, "body": {"message": "Unauthorized"}}
+                if rid == "e"
+                else {"status": 201, "body": {"data": {"id": rid, "last_modified": 1}}}
+                for rid in ids
+            ]
+        }
+        return (200, {}, json.dumps(body))
+
+    responses.add_callback(responses.POST, server + "/batch", callback=batch)
+    client = batch_client(server)
+    operations = [(rid, "create_record", {"data": {"id": rid}}) for rid in "abcde"]
+
+    applied, failed = apply_changes(client, operations, batch_size=2, max_workers=3, retries=1)
+
+    assert sorted(r["data"]["id"] for r in applied) == ["a", "b", "c", "d"]
+    assert failed == [("e", "403 Unauthorized")]
+    # Only the batch that failed was sent again.
+    assert attempts == {("a", "b"): 1, ("c", "d"): 2, ("e",): 1}
+
+
+@responses.activate
+def test_apply_changes_reports_failed_ids_after_retries():
+    server = "https://fake-server.net/v1"
+    responses.add(responses.POST, server + "/batch", status=500, json={"message": "Boom"})
+    client = batch_client(server)
+    operations = [(rid, "delete_record", {"id": rid}) for rid in "ab"]
+
+    applied, failed = apply_changes(client, operations, batch_size=10, max_workers=1, retries=2)
+
+    assert applied == []
+    assert [rid for rid, _ in failed] == ["a", "b"]
+    assert len([c for c in responses.calls if c.request.method == "POST"]) == 3
+
+
+@responses.activate
+def test_apply_changes_retries_network_errors():
+    server = "https://fake-server.net/v1"
+    responses.add(
+        responses.POST, server + "/batch", body=requests.exceptions.ConnectionError("Reset")
+    )
+    responses.add(
+        responses.POST,
+        server + "/batch",
+        json={"responses": [{"status": 201, "body": {"data": {"id": "a", "last_modified": 1}}}]},
+    )
+    responses.add(
+        responses.POST, server + "/batch", body=requests.exceptions.ConnectionError("Reset")
+    )
+    client = batch_client(server)
+    operations = [(rid, "create_record", {"data": {"id": rid}}) for rid in "ab"]
+
+    applied, failed = apply_changes(client, operations, batch_size=1, max_workers=1, retries=1)
+
+    assert [r["data"]["id"] for r in applied] == ["a"]
+    assert failed == [("b", "Reset")]
@@ -1,19 +1,64 @@
+import base64
+import hashlib
+import json
 import os
+import re
+import threading
+import time
+import types
 import zipfile
-from unittest.mock import MagicMock, patch
+from unittest.mock import call, patch
 
+import lz4.block
 import pytest
+import requests
 import responses
+from google.api_core.exceptions import NotFound
 
+from commands import (
+    CloudStorageFileStorage,
+    DiskFileStorage,
+    HostRateLimiter,
+    create_file_storage,
+    create_http_session,
+    resize_http_session_pool,
+)
 from commands.build_bundles import (
+    DEFAULT_MOZLZ4_BUNDLES,
+    AttachmentIntegrityError,
+    AttachmentsCache,
+    BundleError,
+    BundlesPipeline,
+    ChangesetsCache,
     KintoClient,
+    RawRecords,
     build_bundles,
+    build_changesets_delta,
+    bundle_compresslevel,
     call_parallel,
+    changesets_delta,
+    compress_zip_member,
+    copy_zip_member,
+    download_file,
+    encode_changeset,
     fetch_all_changesets,
     fetch_attachment,
+    file_md5,
+    get_attachment,
     get_modified_timestamp,
+    get_published_timestamps,
+    is_precompressed,
+    iter_parallel,
+    merge_changes,
+    parse_bundles_definitions,
+    read_json_mozlz4,
+    reusable_attachments,
+    select_bundles_changesets,
     sync_cloud_storage,
+    write_json_mozlz4,
+    write_raw_zip_member,
     write_zip,
+    zip_date_time,
 )
 
 
@@ -41,12 +86,116 @@ def mock_sync_cloud_storage():
         yield mock_sync_cloud_storage
 
 
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def md5_hash(self):
+        return base64.b64encode(hashlib.md5(self.bucket.blobs[self.name]).digest()).decode()
+
+    def download_as_bytes(self):
+        if self.name not in self.bucket.blobs:
+            raise NotFound(self.name)
+        return self.bucket.blobs[self.name]
+
+    def upload_from_string(self, content, content_type=None):
+        self.bucket.blobs[self.name] = content
+        self.bucket.uploaded.append(self.name)
+
+    def upload_from_filename(self, filename):
+        with open(filename, "rb") as f:
+            self.bucket.blobs[self.name] = f.read()
+        self.bucket.uploaded.append(self.name)
+
+
+class FakeBucket:
+    """
+    Minimal in-memory stand-in for a Cloud Storage bucket.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.blobs = {}
+        self.uploaded = []
+        self.listed = False
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        return FakeBlob(self, name) if name in self.blobs else None
+
+    def list_blobs(self, prefix=""):
+        self.listed = True
+        return [FakeBlob(self, name) for name in self.blobs if name.startswith(prefix)]
+
+    def delete_blob(self, name):
+        if self.client.current_batch is None:
+            raise AssertionError("Blobs should be deleted in batches")
+        self.client.current_batch.append(name)
+        status = self.client.delete_statuses.get(name, 204 if name in self.blobs else 404)
+        self.client.current_responses.append(types.SimpleNamespace(status_code=status))
+        if status < 300:
+            del self.blobs[name]
+
+
+class FakeStorageClient:
+    def __init__(self):
+        self.buckets = {}
+        self.batches = []
+        self.current_batch = None
+        self.current_responses = None
+        self.delete_statuses = {}
+
+    def __call__(self):
+        return self
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, FakeBucket(self))
+
+    def batch(self, raise_exception=True):
+        return FakeBatch(self, raise_exception)
+
+
+class FakeBatch:
+    """
+    Sends the deferred requests when finished, like the Cloud Storage batches.
+    """
+
+    def __init__(self, client, raise_exception):
+        self.client = client
+        self.raise_exception = raise_exception
+
+    def __enter__(self):
+        self.client.current_batch = []
+        self.client.current_responses = []
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.finish(raise_exception=self.raise_exception)
+        finally:
+            self.client.current_batch = None
+
+    def finish(self, raise_exception=True):
+        self.client.batches.append(self.client.current_batch)
+        return self.client.current_responses
+
+
 @pytest.fixture
-def mock_storage_client():
-    with patch("commands.build_bundles.storage.Client") as mock_client:
-        mock_bucket = MagicMock()
-        mock_client.return_value.bucket.return_value = mock_bucket
-        yield mock_bucket
+def fake_storage():
+    fake_client = FakeStorageClient()
+    with patch("commands.build_bundles.storage.Client", fake_client):
+        yield fake_client
+
+
+@pytest.fixture
+def mock_sleep():
+    with patch("backoff._sync.time.sleep") as mock_sleep:
+        yield mock_sleep
 
 
 @pytest.fixture
@@ -63,6 +212,71 @@ def test_call_parallel():
     assert results == [3, 7, 11]
 
 
+def test_create_http_session():
+    session = create_http_session(pool_size=12)
+    adapter = session.get_adapter("https://example.com")
+    assert adapter is session.get_adapter("http://example.com")
+    assert adapter._pool_maxsize == 12
+
+
+def test_call_parallel_raises_errors():
+    def dummy_func(x):
+        if x == 3:
+            raise ValueError(x)
+        return x
+
+    with pytest.raises(ValueError):
+        call_parallel(dummy_func, [(i,) for i in range(10)], max_workers=2)
+
+
+def test_call_parallel_with_rate_limit():
+    with patch("commands.host_rate_limiter", HostRateLimiter(max_per_second=20)):
+        before = time.monotonic()
+        results = call_parallel(lambda x: x, [(i,) for i in range(5)], host="example.com")
+        elapsed = time.monotonic() - before
+
+    assert results == [0, 1, 2, 3, 4]
+    # 4 intervals of 50ms between the 5 calls.
+    assert elapsed >= 0.2
+
+
+def test_host_rate_limiter_is_per_host():
+    limiter = HostRateLimiter(max_per_second=1)
+
+    before = time.monotonic()
+    limiter.wait("a.com")
+    limiter.wait("b.com")
+    assert time.monotonic() - before < 0.5
+
+
+def test_host_rate_limiter_is_shared_by_threads():
+    limiter = HostRateLimiter(max_per_second=200)
+    before = time.monotonic()
+
+    # Nested pools, like when mappings and their batches run in parallel.
+    call_parallel(
+        lambda _: call_parallel(limiter.wait, [("a.com",)] * 5, max_workers=5),
+        [(i,) for i in range(4)],
+    )
+
+    # Every call booked its own slot, 5ms apart.
+    assert limiter._next_slots["a.com"] - before >= 20 * 0.005
+    assert time.monotonic() - before >= 19 * 0.005
+
+
+def test_iter_parallel_is_lazy_and_ordered():
+    calls = []
+
+    def dummy_func(x):
+        calls.append(x)
+        return x * 2
+
+    results = iter_parallel(dummy_func, [(i,) for i in range(10)], max_workers=2)
+    assert calls == []
+    assert list(results) == [i * 2 for i in range(10)]
+    assert sorted(calls) == list(range(10))
+
+
 @responses.activate
 @patch("kinto_http.client.random")
 def test_fetch_all_changesets(mock_random):
@@ -101,6 +315,129 @@ def test_fetch_all_changesets(mock_random):
     assert changesets[1]["metadata"]["id"] == "collection2"
 
 
+def test_disk_changesets_cache(tmpdir):
+    cache = ChangesetsCache(DiskFileStorage(str(tmpdir)))
+    changeset = {"metadata": {"bucket": "main", "id": "cid"}, "timestamp": 42, "changes": []}
+
+    assert cache.get("main", "cid") is None
+    cache.set(changeset)
+    assert cache.get("main", "cid") == changeset
+
+    with open(os.path.join(tmpdir, "main--cid.json"), "w") as f:
+        f.write("{corrupted")
+    assert cache.get("main", "cid") is None
+
+
+def test_changesets_cache_entries_expire(tmpdir):
+    cache = ChangesetsCache(DiskFileStorage(str(tmpdir)))
+    changeset = {"metadata": {"bucket": "main", "id": "cid"}, "timestamp": 42, "changes": []}
+    cache.set(changeset)
+
+    with patch("commands.build_bundles.CHANGESETS_CACHE_MAX_AGE_SECONDS", 60):
+        assert cache.get("main", "cid") == changeset
+        with patch("commands.build_bundles.time.time", return_value=time.time() + 61):
+            # Fetched again entirely, in case its metadata changed.
+            assert cache.get("main", "cid") is None
+
+
+def test_cloud_storage_changesets_cache(fake_storage):
+    cache = ChangesetsCache(create_file_storage("gs://some-bucket/changesets/"))
+    assert isinstance(cache.files, CloudStorageFileStorage)
+    changeset = {"metadata": {"bucket": "main", "id": "cid"}, "timestamp": 42, "changes": []}
+
+    assert cache.get("main", "cid") is None
+    cache.set(changeset)
+    assert cache.get("main", "cid") == changeset
+    assert fake_storage.bucket("some-bucket").uploaded == ["changesets/main--cid.json"]
+
+
+def test_create_file_storage(tmpdir):
+    assert isinstance(create_file_storage(str(tmpdir)), DiskFileStorage)
+    assert create_file_storage(f"file://{tmpdir}").folder == str(tmpdir)
+    with pytest.raises(ValueError):
+        create_file_storage("s3://bucket/folder")
+
+
+def test_merge_changes():
+    cached = [
+        {"id": "b", "last_modified": 20},
+        {"id": "a", "last_modified": 10},
+    ]
+    new_changes = [
+        {"id": "c", "last_modified": 40},
+        {"id": "b", "last_modified": 30, "deleted": True},
+        {"id": "a", "last_modified": 25, "title": "updated"},
+    ]
+
+    assert merge_changes(cached, new_changes) == [
+        {"id": "c", "last_modified": 40},
+        {"id": "a", "last_modified": 25, "title": "updated"},
+    ]
+
+
+@responses.activate
+def test_fetch_all_changesets_with_cache(tmpdir):
+    changeset_url = "http://example.com/v1/buckets/{bid}/collections/{cid}/changeset"
+    responses.add(
+        responses.GET,
+        changeset_url.format(bid="monitor", cid="changes"),
+        json={
+            "changes": [
+                {"bucket": "main", "collection": "unchanged", "last_modified": 100},
+                {"bucket": "main", "collection": "changed", "last_modified": 300},
+                {"bucket": "main", "collection": "new", "last_modified": 400},
+            ]
+        },
+    )
+    changed_call = responses.add(
+        responses.GET,
+        changeset_url.format(bid="main", cid="changed"),
+        match=[responses.matchers.query_param_matcher({"_expected": "300", "_since": "200"})],
+        json={
+            "metadata": {"bucket": "main", "id": "changed"},
+            "timestamp": 300,
+            "changes": [{"id": "b", "last_modified": 300, "deleted": True}],
+        },
+    )
+    responses.add(
+        responses.GET,
+        changeset_url.format(bid="main", cid="new"),
+        match=[responses.matchers.query_param_matcher({"_expected": "400"})],
+        json={
+            "metadata": {"bucket": "main", "id": "new"},
+            "timestamp": 400,
+            "changes": [{"id": "c", "last_modified": 400}],
+        },
+    )
+    cache = ChangesetsCache(DiskFileStorage(str(tmpdir)))
+    unchanged = {
+        "metadata": {"bucket": "main", "id": "unchanged"},
+        "timestamp": 100,
+        "changes": [{"id": "z", "last_modified": 100}],
+    }
+    cache.set(unchanged)
+    cache.set(
+        {
+            "metadata": {"bucket": "main", "id": "changed"},
+            "timestamp": 200,
+            "changes": [{"id": "b", "last_modified": 200}, {"id": "a", "last_modified": 150}],
+        }
+    )
+    client = KintoClient(server_url="http://example.com/v1")
+
+    changesets = fetch_all_changesets(client, cache)
+
+    assert all(isinstance(c["changes"], RawRecords) for c in changesets)
+    assert len(responses.calls) == 3  # monitor/changes, changed and new.
+    assert changed_call.call_count == 1
+    assert changesets[0] == unchanged
+    assert changesets[1]["changes"] == [{"id": "a", "last_modified": 150}]
+    assert changesets[2]["changes"] == [{"id": "c", "last_modified": 400}]
+    # The cache is up to date for the next run.
+    assert cache.get("main", "changed") == changesets[1]
+    assert cache.get("main", "new") == changesets[2]
+
+
 @responses.activate
 def test_fetch_attachment():
     url = "http://example.com/file"
@@ -110,13 +447,160 @@ def test_fetch_attachment():
     assert content == b"file_content"
 
 
+@responses.activate
+def test_fetch_attachment_verifies_size_and_hash():
+    url = "http://example.com/file"
+    responses.add(responses.GET, url, body=b"file_content", status=200)
+
+    content = fetch_attachment(
+        url, expected_size=12, expected_hash=hashlib.sha256(b"file_content").hexdigest()
+    )
+    assert content == b"file_content"
+
+
+@responses.activate
+def test_fetch_attachment_retries_on_mismatch(mock_sleep):
+    url = "http://example.com/file"
+    responses.add(responses.GET, url, body=b"file_", status=200)
+    responses.add(responses.GET, url, body=b"file_content", status=200)
+
+    content = fetch_attachment(url, expected_size=12)
+    assert content == b"file_content"
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_fetch_attachment_retries_on_truncated_body(mock_sleep):
+    url = "http://example.com/file"
+    responses.add(
+        responses.GET, url, body=requests.exceptions.ChunkedEncodingError("Connection broken")
+    )
+    responses.add(responses.GET, url, body=b"file_content", status=200)
+
+    content = fetch_attachment(url, expected_size=12)
+    assert content == b"file_content"
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_fetch_attachment_fails_on_corrupted_body(mock_sleep):
+    url = "http://example.com/file"
+    responses.add(responses.GET, url, body=requests.exceptions.ContentDecodingError("gzip"))
+
+    with pytest.raises(AttachmentIntegrityError, match="could not be read"):
+        fetch_attachment(url)
+
+
+@responses.activate
+def test_fetch_attachment_fails_on_hash_mismatch(mock_sleep):
+    url = "http://example.com/file"
+    responses.add(responses.GET, url, body=b"file_content", status=200)
+
+    with pytest.raises(AttachmentIntegrityError, match="instead of"):
+        fetch_attachment(url, expected_hash=hashlib.sha256(b"other").hexdigest())
+
+
+@responses.activate
+def test_fetch_attachment_fails_on_error_status(mock_sleep):
+    url = "http://example.com/file"
+    responses.add(responses.GET, url, status=503)
+
+    with pytest.raises(AttachmentIntegrityError, match="HTTP 503"):
+        fetch_attachment(url)
+
+
+def test_attachments_cache(tmpdir):
+    cache = AttachmentsCache(str(tmpdir), max_size_bytes=100)
+    content = b"file_content"
+    hash = hashlib.sha256(content).hexdigest()
+
+    assert cache.get(hash) is None
+    assert cache.set(hash, content)
+    assert cache.get(hash) == content
+
+
+def test_attachments_cache_verifies_hash(tmpdir):
+    cache = AttachmentsCache(str(tmpdir), max_size_bytes=100)
+    hash = hashlib.sha256(b"file_content").hexdigest()
+
+    assert not cache.set(hash, b"truncated")
+    assert not cache.set("../../etc/passwd", b"file_content")
+    assert cache.get(hash) is None
+    assert os.listdir(tmpdir) == []
+
+
+def test_attachments_cache_evicts_least_recently_used(tmpdir):
+    cache = AttachmentsCache(str(tmpdir), max_size_bytes=25)
+    contents = [b"a" * 10, b"b" * 10, b"c" * 10]
+    hashes = [hashlib.sha256(c).hexdigest() for c in contents]
+
+    cache.set(hashes[0], contents[0])
+    cache.set(hashes[1], contents[1])
+    os.utime(os.path.join(tmpdir, hashes[1]), (time.time() - 60, time.time() - 60))
+    cache.set(hashes[2], contents[2])
+
+    assert cache.get(hashes[0]) == contents[0]
+    assert cache.get(hashes[1]) is None
+    assert cache.get(hashes[2]) == contents[2]
+
+
+def test_attachments_cache_only_scans_folder_when_full(tmpdir):
+    cache = AttachmentsCache(str(tmpdir), max_size_bytes=25)
+    contents = [bytes([i]) * 5 for i in range(5)]
+
+    with patch("commands.build_bundles.os.scandir", wraps=os.scandir) as mocked:
+        for content in contents:
+            cache.set(hashlib.sha256(content).hexdigest(), content)
+        assert mocked.call_count == 0
+        cache.set(hashlib.sha256(b"f" * 5).hexdigest(), b"f" * 5)
+        assert mocked.call_count == 1
+
+    # The total size is kept after eviction.
+    assert cache._size == sum(os.path.getsize(e.path) for e in os.scandir(tmpdir)) <= 25
+
+
+@responses.activate
+def test_get_attachment_uses_cache(tmpdir):
+    cache = AttachmentsCache(str(tmpdir), max_size_bytes=100)
+    content = b"file_content"
+    record = {
+        "id": "abc",
+        "attachment": {"location": "file", "hash": hashlib.sha256(content).hexdigest()},
+    }
+    responses.add(responses.GET, "http://example.com/file", body=content)
+
+    assert get_attachment(cache, "http://example.com/", record) == content
+    assert get_attachment(cache, "http://example.com/", record) == content
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_download_file(tmpdir):
+    url = "http://example.com/file"
+    responses.add(responses.GET, url, body=b"file_content", status=200)
+    output_path = os.path.join(tmpdir, "file")
+
+    assert download_file(url, output_path)
+    with open(output_path, "rb") as f:
+        assert f.read() == b"file_content"
+
+
+@responses.activate
+def test_download_file_missing(tmpdir):
+    url = "http://example.com/file"
+    responses.add(responses.GET, url, status=404)
+    output_path = os.path.join(tmpdir, "file")
+
+    assert not download_file(url, output_path)
+    assert not os.path.exists(output_path)
+
+
 @responses.activate
 def test_get_modified_timestamp():
     url = "http://example.com/file"
     responses.add(
-        responses.GET,
+        responses.HEAD,
         url,
-        body=b"file_content",
         headers={"Last-Modified": "Wed, 03 Jul 2024 11:04:48 GMT"},
     )
     timestamp = get_modified_timestamp(url)
@@ -126,11 +610,27 @@ def test_get_modified_timestamp():
 @responses.activate
 def test_get_modified_timestamp_missing():
     url = "http://example.com/file"
-    responses.add(responses.GET, url, status=404)
+    responses.add(responses.HEAD, url, status=404)
     timestamp = get_modified_timestamp(url)
     assert timestamp == -1
 
 
+@responses.activate
+def test_get_published_timestamps():
+    base_url = "http://example.com/"
+    responses.add(
+        responses.HEAD,
+        f"{base_url}bundles/a.zip",
+        headers={"Last-Modified": "Wed, 03 Jul 2024 11:04:48 GMT"},
+    )
+    responses.add(responses.HEAD, f"{base_url}bundles/b.zip", status=404)
+
+    timestamps = get_published_timestamps(base_url, ["a.zip", "b.zip"])
+
+    assert timestamps == {"a.zip": 1720004688000, "b.zip": -1}
+    assert all(c.request.method == "HEAD" for c in responses.calls)
+
+
 def test_write_zip(tmpdir):
     content = [("file1.txt", "content1"), ("file2.txt", "content2")]
     output_path = os.path.join(tmpdir, "test.zip")
@@ -142,6 +642,445 @@ def test_write_zip(tmpdir):
         assert zip_file.read("file2.txt") == b"content2"
 
 
+def test_write_zip_from_generator(tmpdir):
+    output_path = os.path.join(tmpdir, "test.zip")
+    write_zip(output_path, ((f"file{i}.txt", b"content%d" % i) for i in range(3)))
+
+    with zipfile.ZipFile(output_path, "r") as zip_file:
+        assert zip_file.namelist() == ["file0.txt", "file1.txt", "file2.txt"]
+        assert zip_file.read("file2.txt") == b"content2"
+
+
+def test_copy_zip_member(tmpdir):
+    source_path = os.path.join(tmpdir, "source.zip")
+    write_zip(source_path, [("a", b"a" * 1000), ("b", b"b" * 1000)])
+    output_path = os.path.join(tmpdir, "output.zip")
+
+    with zipfile.ZipFile(source_path) as source:
+        with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as dest:
+            copy_zip_member(source, dest, "b")
+            dest.writestr("c", b"c" * 1000)
+        source_info = source.getinfo("b")
+
+    with zipfile.ZipFile(output_path) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == ["b", "c"]
+        assert zip_file.read("b") == b"b" * 1000
+        assert zip_file.getinfo("b").compress_size == source_info.compress_size
+
+
+def test_write_zip_with_reused_members(tmpdir):
+    previous_path = os.path.join(tmpdir, "previous.zip")
+    write_zip(previous_path, [("file1.txt", b"content1"), ("file2.txt", b"content2")])
+    output_path = os.path.join(tmpdir, "test.zip")
+
+    write_zip(
+        output_path,
+        [("file3.txt", b"content3")],
+        reused_from=previous_path,
+        reused_members=["file2.txt"],
+    )
+
+    with zipfile.ZipFile(output_path, "r") as zip_file:
+        assert zip_file.testzip() is None
+        assert set(zip_file.namelist()) == {"file2.txt", "file3.txt"}
+        assert zip_file.read("file2.txt") == b"content2"
+        assert zip_file.read("file3.txt") == b"content3"
+
+
+def test_write_zip_stored_members(tmpdir):
+    output_path = os.path.join(tmpdir, "test.zip")
+    write_zip(
+        output_path, [("a.png", b"a" * 1000), ("b.txt", b"b" * 1000)], stored_members={"a.png"}
+    )
+
+    with zipfile.ZipFile(output_path) as zip_file:
+        assert zip_file.getinfo("a.png").compress_type == zipfile.ZIP_STORED
+        assert zip_file.getinfo("a.png").compress_size == 1000
+        assert zip_file.getinfo("b.txt").compress_type == zipfile.ZIP_DEFLATED
+        assert zip_file.read("a.png") == b"a" * 1000
+
+
+def test_write_zip_compresslevel(tmpdir):
+    content = [("file.txt", json.dumps([{"id": f"record-{i}", "n": i * i} for i in range(1000)]))]
+    fast_path = os.path.join(tmpdir, "fast.zip")
+    best_path = os.path.join(tmpdir, "best.zip")
+    write_zip(fast_path, content, compresslevel=1)
+    write_zip(best_path, content, compresslevel=9)
+
+    assert os.path.getsize(best_path) < os.path.getsize(fast_path)
+
+
+def test_write_zip_in_parallel(tmpdir):
+    content = [(f"file{i}", os.urandom(1000).hex()) for i in range(10)]
+    sequential_path = os.path.join(tmpdir, "sequential.zip")
+    parallel_path = os.path.join(tmpdir, "parallel.zip")
+    write_zip(sequential_path, content, stored_members={"file3"}, compresslevel=9)
+    write_zip(parallel_path, content, stored_members={"file3"}, compresslevel=9, workers=3)
+
+    with zipfile.ZipFile(sequential_path) as sequential:
+        with zipfile.ZipFile(parallel_path) as parallel:
+            assert parallel.testzip() is None
+            assert parallel.namelist() == sequential.namelist()
+            for info in sequential.infolist():
+                parallel_info = parallel.getinfo(info.filename)
+                assert parallel_info.compress_type == info.compress_type
+                assert parallel_info.compress_size == info.compress_size
+                assert parallel.read(info.filename) == sequential.read(info.filename)
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_write_zip_is_deterministic(tmpdir, workers):
+    content = [("a", b"a" * 100, zip_date_time(1720004688000)), ("b", b"b" * 100)]
+    first_path = os.path.join(tmpdir, "first.zip")
+    second_path = os.path.join(tmpdir, "second.zip")
+    write_zip(first_path, content, workers=workers)
+    with patch("time.time", return_value=time.time() + 3600):
+        write_zip(second_path, content, workers=workers)
+
+    assert file_md5(first_path) == file_md5(second_path)
+    with zipfile.ZipFile(first_path) as zip_file:
+        assert zip_file.getinfo("a").date_time == (2024, 7, 3, 11, 4, 48)
+        assert zip_file.getinfo("b").date_time == (1980, 1, 1, 0, 0, 0)
+
+
+def test_write_raw_zip_member_mixed_with_other_members(tmpdir):
+    source_path = os.path.join(tmpdir, "source.zip")
+    write_zip(source_path, [("copied", b"a" * 1000)])
+    output_path = os.path.join(tmpdir, "output.zip")
+
+    with zipfile.ZipFile(source_path) as source:
+        with zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED) as dest:
+            dest.writestr("first", b"b" * 1000)
+            copy_zip_member(source, dest, "copied")
+            info, compressed = compress_zip_member("raw", b"c" * 1000, zipfile.ZIP_DEFLATED)
+            write_raw_zip_member(dest, info, [compressed])
+            dest.writestr("last", b"d" * 1000)
+
+    with zipfile.ZipFile(output_path) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.namelist() == ["first", "copied", "raw", "last"]
+        assert zip_file.read("raw") == b"c" * 1000
+
+
+def test_write_raw_zip_member_with_open_handle(tmpdir):
+    info, compressed = compress_zip_member("raw", b"c", zipfile.ZIP_DEFLATED)
+    with zipfile.ZipFile(os.path.join(tmpdir, "output.zip"), "w") as dest:
+        with dest.open("opened", "w"):
+            with pytest.raises(ValueError):
+                write_raw_zip_member(dest, info, [compressed])
+
+
+@pytest.mark.parametrize(
+    "attachment,expected",
+    [
+        ({"mimetype": "image/png", "filename": "logo.png"}, True),
+        ({"mimetype": "application/octet-stream", "filename": "data.mozlz4"}, True),
+        ({"mimetype": "application/octet-stream", "filename": "DATA.BIN"}, True),
+        ({"mimetype": "image/svg+xml", "filename": "logo.svg"}, False),
+        ({"mimetype": "application/json", "filename": "data.json"}, False),
+        ({}, False),
+    ],
+)
+def test_is_precompressed(attachment, expected):
+    assert is_precompressed(attachment) is expected
+
+
+def test_bundle_compresslevel():
+    with patch("commands.build_bundles.ZIP_COMPRESSLEVELS", {"main/big-*": 1, "main/*": 9}):
+        assert bundle_compresslevel("main", "big-collection") == 1
+        assert bundle_compresslevel("main", "small-collection") == 9
+        assert bundle_compresslevel("security-state", "intermediates") == 6
+
+
+def test_reusable_attachments(tmpdir):
+    def attachment(content):
+        return {"hash": hashlib.sha256(content).hexdigest(), "size": len(content)}
+
+    previous_path = os.path.join(tmpdir, "previous.zip")
+    previous_records = [
+        ({"id": "same", "attachment": attachment(b"1")}, b"1"),
+        ({"id": "changed", "attachment": attachment(b"2")}, b"2"),
+        ({"id": "no-hash", "attachment": {"size": 1}}, b"3"),
+        # Published with a bad content under a correct metadata.
+        ({"id": "truncated", "attachment": attachment(b"45")}, b"4"),
+        ({"id": "corrupted", "attachment": attachment(b"6")}, b"7"),
+    ]
+    write_zip(
+        previous_path,
+        [(f"{r['id']}.meta.json", json.dumps(r)) for r, _ in previous_records]
+        + [(r["id"], content) for r, content in previous_records],
+    )
+    records = [
+        {"id": "same", "attachment": attachment(b"1")},
+        {"id": "changed", "attachment": attachment(b"22")},
+        {"id": "no-hash", "attachment": {"size": 1}},
+        {"id": "truncated", "attachment": attachment(b"45")},
+        {"id": "corrupted", "attachment": attachment(b"6")},
+        {"id": "new", "attachment": attachment(b"8")},
+    ]
+
+    assert reusable_attachments(previous_path, records) == {"same"}
+
+
+def test_reusable_attachments_invalid_zip(tmpdir):
+    previous_path = os.path.join(tmpdir, "previous.zip")
+    with open(previous_path, "wb") as f:
+        f.write(b"not a zip")
+
+    assert reusable_attachments(previous_path, [{"id": "a", "attachment": {}}]) == set()
+
+
+def test_write_json_mozlz4(tmpdir):
+    changesets = [
+        {"metadata": {"id": "cid", "bucket": "bid"}, "changes": [{"id": "é"}], "timestamp": 42},
+        {"metadata": {"id": "cid2", "bucket": "bid"}, "changes": [], "timestamp": 43},
+    ]
+    output_path = os.path.join(tmpdir, "changesets.json.mozlz4")
+
+    write_json_mozlz4(output_path, changesets)
+
+    with open(output_path, "rb") as f:
+        content = f.read()
+    # Same output as when the whole JSON was serialized at once.
+    assert content == b"mozLz40\x00" + lz4.block.compress(json.dumps(changesets).encode("utf-8"))
+    assert json.loads(lz4.block.decompress(content[8:])) == changesets
+
+
+def test_encode_changeset():
+    record = {"id": "abc", "attachment": {"hash": "é"}, "last_modified": 1}
+    changeset = {"metadata": {"id": "cid"}, "changes": [record, {"id": "d"}], "timestamp": 42}
+
+    assert encode_changeset(changeset) == json.dumps(changeset).encode("utf-8")
+
+
+def test_raw_records():
+    records = [{"id": "a", "title": "é"}, {"id": "b"}, {"id": "c", "n": [1, 2]}]
+    raw_records = RawRecords(records)
+
+    assert len(raw_records) == 3
+    assert raw_records[0] == records[0]
+    assert raw_records[-1] == records[-1]
+    assert raw_records[1:] == records[1:]
+    assert list(raw_records) == records
+    assert raw_records == records
+    assert raw_records == RawRecords(records)
+    assert raw_records.raw(1) == b'{"id": "b"}'
+    assert raw_records.data == json.dumps(records).encode("utf-8")[1:-1]
+    with pytest.raises(IndexError):
+        raw_records[3]
+    assert RawRecords() == []
+
+
+def test_encode_changeset_with_raw_records():
+    records = [{"id": "a", "last_modified": 1}, {"id": "b", "last_modified": 2}]
+    changeset = {"metadata": {"id": "cid"}, "changes": RawRecords(records), "timestamp": 42}
+
+    expected = json.dumps({**changeset, "changes": records}).encode("utf-8")
+    assert encode_changeset(changeset) == expected
+
+
+def test_write_json_mozlz4_with_raw_records(tmpdir):
+    changesets = [
+        {"metadata": {"id": "cid"}, "changes": [{"id": "a"}], "timestamp": 42},
+        {"metadata": {"id": "cid2"}, "changes": [], "timestamp": 43},
+    ]
+    output_path = os.path.join(tmpdir, "changesets.json.mozlz4")
+
+    write_json_mozlz4(
+        output_path, [{**c, "changes": RawRecords(c["changes"])} for c in changesets]
+    )
+
+    with open(output_path, "rb") as f:
+        content = f.read()
+    assert content == b"mozLz40\x00" + lz4.block.compress(json.dumps(changesets).encode("utf-8"))
+
+
+def test_write_json_mozlz4_empty(tmpdir):
+    output_path = os.path.join(tmpdir, "startup.json.mozlz4")
+
+    write_json_mozlz4(output_path, [])
+
+    with open(output_path, "rb") as f:
+        assert lz4.block.decompress(f.read()[8:]) == b"[]"
+
+
+def test_parse_bundles_definitions():
+    definitions = parse_bundles_definitions(
+        '[{"name": "a.json.mozlz4", "flags": ["startup"]}, {"name": "b.json.mozlz4"}]'
+    )
+    assert [d["name"] for d in definitions] == [
+        "changesets.json.mozlz4",
+        "startup.json.mozlz4",
+        "a.json.mozlz4",
+        "b.json.mozlz4",
+    ]
+
+
+def test_parse_bundles_definitions_defaults():
+    assert parse_bundles_definitions(None) == DEFAULT_MOZLZ4_BUNDLES
+    assert parse_bundles_definitions("") == DEFAULT_MOZLZ4_BUNDLES
+
+
+def test_parse_bundles_definitions_override_defaults():
+    definitions = parse_bundles_definitions(
+        [{"name": "startup.json.mozlz4", "flags": ["startup"], "include_preview": True}]
+    )
+    assert definitions == [
+        {"name": "changesets.json.mozlz4"},
+        {"name": "startup.json.mozlz4", "flags": ["startup"], "include_preview": True},
+    ]
+
+
+@pytest.mark.parametrize(
+    "definitions",
+    [
+        [{"flags": ["startup"]}],
+        [{"name": "a", "flag": "startup"}],
+        [{"name": "a"}, {"name": "a"}],
+        [{"name": "a", "flags": "startup"}],
+        [{"name": "a", "buckets": "main*"}],
+        [{"name": "a", "collections": "main/regions"}],
+        [{"name": "a", "collections": [["main/regions"]]}],
+        [{"name": "main--regions.zip"}],
+        [{"name": "bundles-timestamps.json"}],
+        [{"name": "changesets-deltas.json"}],
+        [{"name": "changesets-delta--1--2.json.mozlz4"}],
+    ],
+)
+def test_parse_bundles_definitions_invalid(definitions):
+    with pytest.raises(ValueError):
+        parse_bundles_definitions(definitions)
+
+
+def test_select_bundles_changesets():
+    changesets = [
+        {"metadata": {"bucket": "main", "id": "a", "flags": ["startup"]}, "timestamp": 1},
+        {"metadata": {"bucket": "main", "id": "b"}, "timestamp": 5},
+        {"metadata": {"bucket": "main-preview", "id": "a", "flags": ["startup"]}, "timestamp": 9},
+        {"metadata": {"bucket": "security-state", "id": "c"}, "timestamp": 3},
+    ]
+    definitions = [
+        {"name": "all"},
+        {"name": "startup", "flags": ["startup"]},
+        {"name": "main", "buckets": ["main*"], "include_preview": True},
+        {"name": "explicit", "collections": ["security-state/c"]},
+    ]
+
+    selected, latest_timestamps = select_bundles_changesets(definitions, changesets)
+
+    def ids(name):
+        return [f"{c['metadata']['bucket']}/{c['metadata']['id']}" for c in selected[name]]
+
+    assert ids("all") == ["main/a", "main/b", "security-state/c"]
+    assert ids("startup") == ["main/a"]
+    assert ids("main") == ["main/a", "main/b", "main-preview/a"]
+    assert ids("explicit") == ["security-state/c"]
+    assert latest_timestamps == {"all": 5, "startup": 5, "main": 9, "explicit": 3}
+
+
+def test_read_json_mozlz4(tmpdir):
+    output_path = os.path.join(tmpdir, "changesets.json.mozlz4")
+    write_json_mozlz4(output_path, [{"changes": []}])
+
+    assert read_json_mozlz4(output_path) == [{"changes": []}]
+
+
+def test_changesets_delta():
+    previous = [
+        {
+            "metadata": {"bucket": "main", "id": "a"},
+            "timestamp": 10,
+            "changes": [
+                {"id": "same", "last_modified": 1},
+                {"id": "updated", "age": 1, "last_modified": 2},
+                {"id": "deleted", "last_modified": 3},
+                {"id": "touched", "last_modified": 4},
+            ],
+        },
+        {"metadata": {"bucket": "main", "id": "unchanged"}, "timestamp": 5, "changes": []},
+        {"metadata": {"bucket": "main", "id": "removed"}, "timestamp": 5, "changes": []},
+    ]
+    current = [
+        {
+            "metadata": {"bucket": "main", "id": "a"},
+            "timestamp": 20,
+            "changes": [
+                {"id": "created", "last_modified": 20},
+                {"id": "updated", "age": 2, "last_modified": 15},
+                {"id": "same", "last_modified": 1},
+                {"id": "touched", "last_modified": 19},
+            ],
+        },
+        {"metadata": {"bucket": "main", "id": "unchanged"}, "timestamp": 5, "changes": []},
+        {"metadata": {"bucket": "main", "id": "new"}, "timestamp": 18, "changes": [{"id": "x"}]},
+    ]
+
+    delta = changesets_delta(previous, current)
+
+    assert delta == [
+        {
+            "metadata": {"bucket": "main", "id": "a"},
+            "timestamp": 20,
+            "changes": [
+                {"id": "created", "last_modified": 20},
+                {"id": "updated", "age": 2, "last_modified": 15},
+                # Only its timestamp changed.
+                {"id": "touched", "last_modified": 19},
+                {"id": "deleted", "deleted": True},
+            ],
+        },
+        {"metadata": {"bucket": "main", "id": "new"}, "timestamp": 18, "changes": [{"id": "x"}]},
+        {"metadata": {"bucket": "main", "id": "removed"}, "deleted": True, "changes": []},
+    ]
+    # Records are left untouched.
+    assert current[0]["changes"][1]["last_modified"] == 15
+
+
+@responses.activate
+def test_build_changesets_delta(tmpdir):
+    os.chdir(tmpdir)
+    base_url = "http://example.com/"
+    previous = [{"metadata": {"bucket": "main", "id": "a"}, "timestamp": 10, "changes": []}]
+    write_json_mozlz4("published.json.mozlz4", previous)
+    with open("published.json.mozlz4", "rb") as f:
+        responses.add(responses.GET, f"{base_url}bundles/changesets.json.mozlz4", body=f.read())
+    responses.add(
+        responses.GET,
+        f"{base_url}bundles/changesets-deltas.json",
+        json={
+            "timestamp": 10,
+            "deltas": [
+                {"from": 1, "to": 5, "filename": "changesets-delta--1--5.json.mozlz4"},
+                {"from": 5, "to": 10, "filename": "changesets-delta--5--10.json.mozlz4"},
+            ],
+        },
+    )
+    current = [
+        {"metadata": {"bucket": "main", "id": "a"}, "timestamp": 20, "changes": [{"id": "r"}]}
+    ]
+
+    with patch("commands.build_bundles.CHANGESETS_DELTAS_HISTORY", 2):
+        to_upload, to_delete = build_changesets_delta(base_url, "changesets.json.mozlz4", current)
+
+    assert to_upload == ["changesets-delta--10--20.json.mozlz4", "changesets-deltas.json"]
+    assert to_delete == ["changesets-delta--1--5.json.mozlz4"]
+    assert read_json_mozlz4("changesets-delta--10--20.json.mozlz4") == current
+    with open("changesets-deltas.json") as f:
+        manifest = json.load(f)
+    assert manifest["timestamp"] == 20
+    assert [(d["from"], d["to"]) for d in manifest["deltas"]] == [(5, 10), (10, 20)]
+
+
+@responses.activate
+def test_build_changesets_delta_first_run(tmpdir):
+    os.chdir(tmpdir)
+    base_url = "http://example.com/"
+    responses.add(responses.GET, f"{base_url}bundles/changesets.json.mozlz4", status=404)
+
+    assert build_changesets_delta(base_url, "changesets.json.mozlz4", []) == ([], [])
+
+
 @responses.activate
 def test_build_bundles(
     mock_fetch_all_changesets, mock_write_zip, mock_write_json_mozlz4, mock_sync_cloud_storage
@@ -154,13 +1093,16 @@ def test_build_bundles(
         server_url,
         json={"capabilities": {"attachments": {"base_url": f"{server_url}/attachments/"}}},
     )
+    responses.add(
+        responses.GET, f"{server_url}/attachments/bundles/bundles-timestamps.json", status=404
+    )
     responses.add(responses.GET, f"{server_url}/attachments/file.jpg", body=b"jpeg_content")
 
     for bundle in ["changesets.json.mozlz4", "startup.json.mozlz4"] + [
         f"bucket{i}--collection{i}.zip" for i in range(5)
     ]:
         responses.add(
-            responses.GET,
+            responses.HEAD,
             f"{server_url}/attachments/bundles/{bundle}",
             headers={
                 "Last-Modified": "Wed, 03 Jul 2024 11:04:48 GMT"  # 1720004688000
@@ -178,7 +1120,10 @@ def test_build_bundles(
         },
         {
             "changes": [
-                {"id": "record1", "attachment": {"location": "file.jpg", "size": 10000000}},
+                {
+                    "id": "record1",
+                    "attachment": {"location": "file.jpg", "size": 12, "mimetype": "image/jpeg"},
+                },
                 {"id": "record2"},
             ],
             "metadata": {"id": "collection1", "bucket": "bucket1", "attachment": {"bundle": True}},
@@ -223,7 +1168,7 @@ def test_build_bundles(
         },
     ]
     responses.add(
-        responses.GET,
+        responses.HEAD,
         f"{server_url}/attachments/bundles/bucket6--collection6.zip",
         status=404,
     )
@@ -234,12 +1179,15 @@ def test_build_bundles(
     calls = mock_write_zip.call_args_list
 
     # Assert the first call (attachments zip)
-    attachments_zip_path, attachments_zip_files = calls[0][0]
+    attachments_zip_path, attachments_zip_content = calls[0][0]
+    attachments_zip_files = list(attachments_zip_content)
     assert attachments_zip_path == "bucket1--collection1.zip"
     assert len(attachments_zip_files) == 2
     assert attachments_zip_files[0][0] == "record1.meta.json"
     assert attachments_zip_files[1][0] == "record1"
     assert attachments_zip_files[1][1] == b"jpeg_content"
+    # JPEG images are already compressed.
+    assert calls[0][1]["stored_members"] == {"record1"}
 
     # Assert the mozlz4 call
     assert mock_write_json_mozlz4.call_count == 2  # changesets.json.mozlz4 and startup.json.mozlz
@@ -259,42 +1207,463 @@ def test_build_bundles(
     assert startup_changesets[0]["metadata"]["bucket"] == "bucket5"
     assert startup_changesets[0]["metadata"]["id"] == "collection5"
 
-    mock_sync_cloud_storage.assert_called_once_with(
-        "remote-settings-test-local-attachments",
-        "bundles",
-        [
-            "bucket1--collection1.zip",
-            "changesets.json.mozlz4",
-            "startup.json.mozlz4",
-        ],
+    assert mock_sync_cloud_storage.call_args_list == [
+        call(
+            "remote-settings-test-local-attachments",
+            "bundles",
+            [
+                "bucket1--collection1.zip",
+                "changesets.json.mozlz4",
+                "startup.json.mozlz4",
+            ],
+            [
+                "bucket2--collection2.zip",
+                "bucket3--collection3.zip",
+                "bucket5--collection5.zip",
+                "preview-bucket5--collection5.zip",
+                "bucket6--collection6.zip",
+            ],
+        ),
+        # The source timestamps of the bundles are published once they are.
+        call("remote-settings-test-local-attachments", "bundles", ["bundles-timestamps.json"], []),
+    ]
+    with open("bundles-timestamps.json") as f:
+        assert json.load(f) == {
+            "bucket1--collection1.zip": 1720004688000 + 10,
+            "changesets.json.mozlz4": 1720004688000 + 10,
+            "startup.json.mozlz4": 1720004688000 + 10,
+        }
+
+
+def test_sync_cloud_storage_upload_and_delete(tmpdir, fake_storage, mock_environment):
+    bucket = fake_storage.bucket("remote-bucket")
+    bucket.blobs = {"remote/file3.txt": b"3", "remote/file5.txt": b"5"}
+    os.chdir(tmpdir)
+    for filename in ["file1.txt", "file2.txt"]:
+        with open(filename, "wb") as f:
+            f.write(filename.encode())
+
+    sync_cloud_storage(
+        "remote-bucket", "remote", ["file1.txt", "file2.txt"], ["file3.txt", "file4.txt"]
+    )
+
+    assert bucket.blobs == {
+        "remote/file1.txt": b"file1.txt",
+        "remote/file2.txt": b"file2.txt",
+        "remote/file5.txt": b"5",
+    }
+    # Blobs are deleted by name, in a batch.
+    assert not bucket.listed
+    assert fake_storage.batches == [["remote/file3.txt", "remote/file4.txt"]]
+
+
+def test_sync_cloud_storage_skips_identical_content(tmpdir, fake_storage, mock_environment):
+    bucket = fake_storage.bucket("remote-bucket")
+    bucket.blobs = {"remote/same.txt": b"same", "remote/changed.txt": b"before"}
+    os.chdir(tmpdir)
+    for filename, content in [("same.txt", b"same"), ("changed.txt", b"after")]:
+        with open(filename, "wb") as f:
+            f.write(content)
+
+    sync_cloud_storage("remote-bucket", "remote", ["same.txt", "changed.txt"], [])
+
+    assert bucket.uploaded == ["remote/changed.txt"]
+    assert bucket.blobs["remote/changed.txt"] == b"after"
+
+
+def test_file_md5(tmpdir):
+    path = os.path.join(tmpdir, "file")
+    with open(path, "wb") as f:
+        f.write(b"file_content")
+
+    assert file_md5(path) == base64.b64encode(hashlib.md5(b"file_content").digest()).decode()
+
+
+def test_sync_cloud_storage_deletes_in_chunks(fake_storage, mock_environment):
+    with patch("commands.build_bundles.STORAGE_DELETE_BATCH_SIZE", 2):
+        sync_cloud_storage("remote-bucket", "remote", [], ["a", "b", "c"])
+
+    assert fake_storage.batches == [["remote/a", "remote/b"], ["remote/c"]]
+
+
+def test_sync_cloud_storage_reports_delete_failures(fake_storage, mock_environment):
+    bucket = fake_storage.bucket("remote-bucket")
+    bucket.blobs = {"remote/a": b"a", "remote/b": b"b"}
+    fake_storage.delete_statuses = {"remote/b": 403}
+
+    with pytest.raises(BundleError, match=r"Could not delete b \(HTTP 403\)"):
+        sync_cloud_storage("remote-bucket", "remote", [], ["a", "b", "missing"])
+
+    # Other deletions went through, and missing blobs are ignored.
+    assert bucket.blobs == {"remote/b": b"b"}
+
+
+@responses.activate
+def test_build_bundles_incremental(
+    tmpdir, mock_fetch_all_changesets, mock_write_json_mozlz4, mock_sync_cloud_storage
+):
+    server_url = "http://testserver"
+    responses.add(
+        responses.GET,
+        server_url,
+        json={"capabilities": {"attachments": {"base_url": f"{server_url}/attachments/"}}},
+    )
+    responses.add(
+        responses.GET, f"{server_url}/attachments/bundles/bundles-timestamps.json", status=404
+    )
+    unchanged = {
+        "id": "unchanged",
+        "attachment": {"location": "a", "hash": hashlib.sha256(b"a").hexdigest(), "size": 1},
+    }
+    changed = {
+        "id": "changed",
+        "attachment": {"location": "b2", "hash": hashlib.sha256(b"b2").hexdigest(), "size": 2},
+    }
+    previous_path = os.path.join(tmpdir, "previous.zip")
+    write_zip(
+        previous_path,
         [
-            "bucket2--collection2.zip",
-            "bucket3--collection3.zip",
-            "bucket5--collection5.zip",
-            "preview-bucket5--collection5.zip",
-            "bucket6--collection6.zip",
+            ("unchanged.meta.json", json.dumps(unchanged)),
+            ("unchanged", b"a"),
+            ("changed.meta.json", json.dumps({"id": "changed", "attachment": {"hash": "b1"}})),
+            ("changed", b"b1"),
         ],
     )
+    responses.add(
+        responses.HEAD,
+        f"{server_url}/attachments/bundles/bid--cid.zip",
+        headers={"Last-Modified": "Wed, 03 Jul 2024 11:04:48 GMT"},
+    )
+    with open(previous_path, "rb") as f:
+        responses.add(
+            responses.GET, f"{server_url}/attachments/bundles/bid--cid.zip", body=f.read()
+        )
+    responses.add(responses.GET, f"{server_url}/attachments/b2", body=b"b2")
+    for bundle in ["changesets.json.mozlz4", "startup.json.mozlz4"]:
+        responses.add(responses.HEAD, f"{server_url}/attachments/bundles/{bundle}", status=404)
+    mock_fetch_all_changesets.return_value = [
+        {
+            "changes": [unchanged, changed],
+            "metadata": {"id": "cid", "bucket": "bid", "attachment": {"bundle": True}},
+            "timestamp": 1720004688000 + 10,
+        },
+    ]
 
+    with (
+        patch("commands.build_bundles.INCREMENTAL_BUNDLES", True),
+        patch("commands.build_bundles.ATTACHMENTS_CACHE_MAX_SIZE_BYTES", 0),
+    ):
+        build_bundles({"server": server_url}, context={})
 
-def test_sync_cloud_storage_upload_and_delete(mock_storage_client, mock_environment):
-    bucket = mock_storage_client
+    fetched = [c.request.url for c in responses.calls if "/attachments/" in c.request.url]
+    assert f"{server_url}/attachments/a" not in fetched
+    assert f"{server_url}/attachments/b2" in fetched
+    with zipfile.ZipFile("bid--cid.zip") as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.read("unchanged") == b"a"
+        assert zip_file.read("changed") == b"b2"
+        assert json.loads(zip_file.read("changed.meta.json")) == changed
 
-    mock_blob1 = MagicMock()
-    mock_blob2 = MagicMock()
-    bucket.blob.side_effect = [mock_blob1, mock_blob2]
 
-    mock_blob3 = MagicMock()
-    mock_blob3.name = "remote/file3.txt"
-    bucket.list_blobs.return_value = [mock_blob1, mock_blob2, mock_blob3]
+@responses.activate
+def test_build_bundles_reports_corrupted_attachments(
+    mock_sleep, mock_fetch_all_changesets, mock_write_json_mozlz4, mock_sync_cloud_storage
+):
+    server_url = "http://testserver"
+    responses.add(
+        responses.GET,
+        server_url,
+        json={"capabilities": {"attachments": {"base_url": f"{server_url}/attachments/"}}},
+    )
+    responses.add(
+        responses.GET, f"{server_url}/attachments/bundles/bundles-timestamps.json", status=404
+    )
+    for bundle in ["changesets.json.mozlz4", "startup.json.mozlz4", "bid--cid.zip"]:
+        responses.add(responses.HEAD, f"{server_url}/attachments/bundles/{bundle}", status=404)
+    responses.add(responses.GET, f"{server_url}/attachments/file", body=b"truncated")
+    mock_fetch_all_changesets.return_value = [
+        {
+            "changes": [{"id": "record1", "attachment": {"location": "file", "size": 100}}],
+            "metadata": {"id": "cid", "bucket": "bid", "attachment": {"bundle": True}},
+            "timestamp": 42,
+        },
+    ]
 
-    sync_cloud_storage(
-        "remote-bucket", "remote", ["file1.txt", "file2.txt"], ["file3.txt", "file4.txt"]
+    with pytest.raises(BundleError, match="Record 'record1'"):
+        build_bundles({"server": server_url}, context={})
+
+    # Other bundles are still published.
+    uploaded = mock_sync_cloud_storage.call_args_list[0][0][2]
+    assert uploaded == ["changesets.json.mozlz4", "startup.json.mozlz4"]
+    # The failed bundle is not marked as built.
+    with open("bundles-timestamps.json") as f:
+        assert "bid--cid.zip" not in json.load(f)
+
+
+@responses.activate
+def test_build_bundles_identical_content_is_not_uploaded_again(
+    tmpdir, mock_fetch_all_changesets, fake_storage, mock_environment
+):
+    os.chdir(tmpdir)
+    server_url = "http://testserver"
+    bundles_url = f"{server_url}/attachments/bundles"
+    bucket = fake_storage.bucket("remote-settings-test-local-attachments")
+    responses.add(
+        responses.GET,
+        server_url,
+        json={"capabilities": {"attachments": {"base_url": f"{server_url}/attachments/"}}},
+    )
+    responses.add(responses.GET, f"{server_url}/attachments/file", body=b"content")
+
+    def published(request):
+        name = request.url.replace(f"{server_url}/attachments/", "")
+        if name not in bucket.blobs:
+            return (404, {}, b"")
+        # The bundles were all published before the latest change.
+        body = b"" if request.method == "HEAD" else bucket.blobs[name]
+        return (200, {"Last-Modified": "Wed, 03 Jul 2024 11:04:48 GMT"}, body)
+
+    for method in (responses.GET, responses.HEAD):
+        responses.add_callback(method, re.compile(f"{bundles_url}/.*"), callback=published)
+
+    def run(extra_records):
+        mock_fetch_all_changesets.return_value = [
+            {
+                "changes": [
+                    {
+                        "id": "r",
+                        "last_modified": 1720004688000 - 10,
+                        "attachment": {"location": "file", "size": 7},
+                    },
+                    *extra_records,
+                ],
+                "metadata": {"id": "cid", "bucket": "bid", "attachment": {"bundle": True}},
+                "timestamp": max(r["last_modified"] for r in extra_records),
+            }
+        ]
+        build_bundles({"server": server_url}, context={})
+
+    run([{"id": "other", "last_modified": 1720004688000 + 10}])
+    assert bucket.uploaded.count("bundles/bid--cid.zip") == 1
+
+    # A record without attachment changed, a while later: the rebuilt Zip is identical.
+    with patch("time.time", return_value=time.time() + 3600):
+        run([{"id": "other", "last_modified": 1720004688000 + 20}])
+    assert bucket.uploaded.count("bundles/bid--cid.zip") == 1
+    assert bucket.uploaded.count("bundles/changesets.json.mozlz4") == 2
+
+    # Its publication date is older than the change, but it is not rebuilt anymore.
+    fetches = len([c for c in responses.calls if c.request.url.endswith("/attachments/file")])
+    run([{"id": "other", "last_modified": 1720004688000 + 20}])
+    assert (
+        len([c for c in responses.calls if c.request.url.endswith("/attachments/file")]) == fetches
+    )
+
+
+@responses.activate
+def test_build_bundles_pipelined(
+    mock_fetch_all_changesets, mock_write_json_mozlz4, mock_sync_cloud_storage
+):
+    server_url = "http://testserver"
+    responses.add(
+        responses.GET,
+        server_url,
+        json={"capabilities": {"attachments": {"base_url": f"{server_url}/attachments/"}}},
+    )
+    responses.add(
+        responses.GET, f"{server_url}/attachments/bundles/bundles-timestamps.json", status=404
+    )
+    for bundle in ["changesets.json.mozlz4", "startup.json.mozlz4"]:
+        responses.add(responses.HEAD, f"{server_url}/attachments/bundles/{bundle}", status=404)
+    mock_fetch_all_changesets.return_value = []
+    for i in range(3):
+        responses.add(
+            responses.HEAD, f"{server_url}/attachments/bundles/bid--cid{i}.zip", status=404
+        )
+        responses.add(responses.GET, f"{server_url}/attachments/file{i}", body=b"content")
+        mock_fetch_all_changesets.return_value.append(
+            {
+                "changes": [{"id": "r", "attachment": {"location": f"file{i}", "size": 7}}],
+                "metadata": {"id": f"cid{i}", "bucket": "bid", "attachment": {"bundle": True}},
+                "timestamp": 42,
+            }
+        )
+
+    with patch("commands.build_bundles.BUNDLES_PIPELINE_WORKERS", 2):
+        build_bundles({"server": server_url}, context={})
+
+    calls = mock_sync_cloud_storage.call_args_list
+    # Each bundle is uploaded on its own as soon as it is built.
+    uploaded_alone = sorted(c[0][2][0] for c in calls[:-2])
+    assert uploaded_alone == ["bid--cid0.zip", "bid--cid1.zip", "bid--cid2.zip"]
+    assert all(c[1] == {"to_delete": []} for c in calls[:-2])
+    # The next call uploads the other bundles, and the last one their timestamps.
+    assert calls[-2][0][2] == ["changesets.json.mozlz4", "startup.json.mozlz4"]
+    assert calls[-1][0][2] == ["bundles-timestamps.json"]
+    with open("bundles-timestamps.json") as f:
+        assert json.load(f)["bid--cid1.zip"] == 42
+    for i in range(3):
+        with zipfile.ZipFile(f"bid--cid{i}.zip") as zip_file:
+            assert zip_file.read("r") == b"content"
+
+
+def test_bundles_pipeline_bounds_queued_builds():
+    running = []
+    max_running = []
+    release = threading.Event()
+
+    def build(name):
+        running.append(name)
+        max_running.append(len(running))
+        release.wait(timeout=1)
+        running.remove(name)
+        return name
+
+    pipeline = BundlesPipeline(workers=1)
+    for i in range(2):
+        pipeline.submit(build, f"b{i}")
+    # The third submission waits for a build to complete.
+    submitter = threading.Thread(target=pipeline.submit, args=(build, "b2"))
+    submitter.start()
+    submitter.join(timeout=0.1)
+    assert submitter.is_alive()
+    release.set()
+    submitter.join()
+
+    assert pipeline.wait() == (["b0", "b1", "b2"], [])
+
+
+def test_bundles_pipeline_waits_for_uploads_on_unexpected_error():
+    uploaded = []
+
+    def build(name):
+        if name == "broken":
+            raise RuntimeError(name)
+        return name
+
+    def upload(filenames):
+        time.sleep(0.05)
+        uploaded.extend(filenames)
+
+    pipeline = BundlesPipeline(workers=1, upload=upload)
+    pipeline.submit(build, "ok")
+    pipeline.submit(build, "broken")
+
+    with pytest.raises(RuntimeError):
+        pipeline.wait()
+
+    assert uploaded == ["ok"]
+    assert pipeline.builders._shutdown
+    assert pipeline.uploader._shutdown
+
+
+def test_resize_http_session_pool():
+    session = create_http_session(pool_size=4)
+
+    resize_http_session_pool(session, 12)
+    assert session.get_adapter("https://example.com")._pool_maxsize == 12
+    resize_http_session_pool(session, 8)
+    assert session.get_adapter("http://example.com")._pool_maxsize == 12
+
+
+@responses.activate
+def test_build_bundles_with_custom_definitions(
+    mock_fetch_all_changesets, mock_write_json_mozlz4, mock_sync_cloud_storage
+):
+    server_url = "http://testserver"
+    responses.add(
+        responses.GET,
+        server_url,
+        json={"capabilities": {"attachments": {"base_url": f"{server_url}/attachments/"}}},
+    )
+    responses.add(
+        responses.GET, f"{server_url}/attachments/bundles/bundles-timestamps.json", status=404
+    )
+    responses.add(
+        responses.HEAD,
+        f"{server_url}/attachments/bundles/first-paint.json.mozlz4",
+        headers={"Last-Modified": "Wed, 03 Jul 2024 11:04:48 GMT"},  # 1720004688000
+    )
+    responses.add(
+        responses.HEAD, f"{server_url}/attachments/bundles/regions.json.mozlz4", status=404
+    )
+    for name in ("changesets.json.mozlz4", "startup.json.mozlz4"):
+        responses.add(
+            responses.HEAD,
+            f"{server_url}/attachments/bundles/{name}",
+            headers={"Last-Modified": "Wed, 03 Jul 2024 11:04:48 GMT"},  # 1720004688000
+        )
+    mock_fetch_all_changesets.return_value = [
+        {
+            "changes": [],
+            "metadata": {"id": "cid", "bucket": "main", "flags": ["first-paint"]},
+            "timestamp": 1720004688000 - 10,
+        },
+        {
+            "changes": [],
+            "metadata": {"id": "regions", "bucket": "security-state"},
+            "timestamp": 1720004688000 + 10,
+        },
+    ]
+
+    build_bundles(
+        {
+            "server": server_url,
+            "mozlz4_bundles": json.dumps(
+                [
+                    {
+                        "name": "first-paint.json.mozlz4",
+                        "flags": ["first-paint"],
+                        "buckets": ["main"],
+                    },
+                    {"name": "regions.json.mozlz4", "collections": ["security-state/regions"]},
+                ]
+            ),
+        },
+        context={},
+    )
+
+    # The first-paint bundle was published after its collections last changes.
+    # The default bundles are still built along the custom ones.
+    written = {
+        path: [c["metadata"]["id"] for c in changesets]
+        for (path, changesets), _ in mock_write_json_mozlz4.call_args_list
+    }
+    assert written == {
+        "changesets.json.mozlz4": ["cid", "regions"],
+        "startup.json.mozlz4": [],
+        "regions.json.mozlz4": ["regions"],
+    }
+
+
+@responses.activate
+def test_build_bundles_releases_unused_records(
+    mock_fetch_all_changesets, mock_write_json_mozlz4, mock_sync_cloud_storage
+):
+    server_url = "http://testserver"
+    responses.add(
+        responses.GET,
+        server_url,
+        json={"capabilities": {"attachments": {"base_url": f"{server_url}/attachments/"}}},
+    )
+    responses.add(
+        responses.GET, f"{server_url}/attachments/bundles/bundles-timestamps.json", status=404
     )
+    for bundle in ["changesets.json.mozlz4", "startup.json.mozlz4"]:
+        responses.add(responses.HEAD, f"{server_url}/attachments/bundles/{bundle}", status=404)
+    main_changeset = {
+        "changes": [{"id": "a", "last_modified": 42}],
+        "metadata": {"id": "cid", "bucket": "main"},
+        "timestamp": 42,
+    }
+    preview_changeset = {
+        "changes": [{"id": "a", "last_modified": 42}],
+        "metadata": {"id": "cid", "bucket": "main-preview"},
+        "timestamp": 42,
+    }
+    mock_fetch_all_changesets.return_value = [main_changeset, preview_changeset]
 
-    # Check uploads
-    mock_blob1.upload_from_filename.assert_called_once_with("file1.txt")
-    mock_blob2.upload_from_filename.assert_called_once_with("file2.txt")
+    build_bundles({"server": server_url}, context={})
 
-    # Check deletions
-    mock_blob3.delete.assert_called_once()
+    assert main_changeset["changes"] == [{"id": "a", "last_modified": 42}]
+    assert preview_changeset["changes"] == []
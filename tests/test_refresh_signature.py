@@ -1,10 +1,22 @@
+import json
 import unittest
 from datetime import datetime, timedelta, timezone
 from unittest import mock
 
+import pytest
+import requests
 import responses
 
-from commands.refresh_signature import refresh_signature
+from commands import SignerIndex
+from commands.refresh_signature import (
+    RefreshError,
+    get_collections_metadata,
+    get_signed_source,
+    project_refresh_load,
+    refresh_signature,
+    schedule_refresh,
+    stagger_slot,
+)
 
 
 SERVER_INFO = {
@@ -37,40 +49,53 @@ class TestSignatureRefresh(unittest.TestCase):
     server = "https://fake-server.net/v1"
     auth = ("foo", "bar")
 
-    @responses.activate
-    def test_skip_recently_signed(self):
+    def mock_server(self, collections, batch_responses=None):
+        responses.add(responses.GET, self.server + "/", json=SERVER_INFO)
         responses.add(
             responses.GET,
-            self.server + "/",
-            json=SERVER_INFO,
+            self.server + "/buckets/monitor/collections/changes/records",
+            json=MONITOR_CHANGES,
         )
-
         responses.add(
             responses.GET,
-            self.server + "/buckets/monitor/collections/changes/records",
-            json=MONITOR_CHANGES,
+            self.server + "/buckets/main-workspace/collections",
+            json={"data": collections},
         )
 
-        for cid, date in [
-            ("search-config", "2019-01-11T15:11:07.807323+00:00"),
-            ("top-sites", "2019-01-18T15:11:07.807323+00:00"),
-        ]:
-            responses.add(
-                responses.GET,
-                self.server + "/buckets/main-workspace/collections/" + cid,
-                json={
-                    "data": {"last_modified": 42, "last_signature_date": date},
+        def batch(request):
+            requests = json.loads(request.body)["requests"]
+            body = {
+                "responses": batch_responses
+                or [{"status": 200, "body": {"data": {"last_modified": 43}}} for _ in requests]
+            }
+            return (200, {}, json.dumps(body))
+
+        responses.add_callback(responses.POST, self.server + "/batch", callback=batch)
+
+    def batch_requests(self):
+        return [
+            request
+            for call in responses.calls
+            if call.request.method == "POST"
+            for request in json.loads(call.request.body)["requests"]
+        ]
+
+    @responses.activate
+    def test_skip_recently_signed(self):
+        self.mock_server(
+            [
+                {
+                    "id": "search-config",
+                    "last_modified": 42,
+                    "last_signature_date": "2019-01-11T15:11:07.807323+00:00",
                 },
-            )
-            responses.add(
-                responses.PATCH,
-                self.server + "/buckets/main-workspace/collections/" + cid,
-                json={
-                    "data": {
-                        "last_modified": 43,
-                    }
+                {
+                    "id": "top-sites",
+                    "last_modified": 42,
+                    "last_signature_date": "2019-01-18T15:11:07.807323+00:00",
                 },
-            )
+            ]
+        )
 
         patch = mock.patch("commands.refresh_signature.utcnow")
         self.addCleanup(patch.stop)
@@ -85,43 +110,23 @@ class TestSignatureRefresh(unittest.TestCase):
             context=None,
         )
 
-        patch_requests = [r for r in responses.calls if r.request.method == "PATCH"]
+        patch_requests = self.batch_requests()
 
         assert len(patch_requests) == 1
+        assert patch_requests[0]["method"] == "PATCH"
+        assert patch_requests[0]["path"] == "/buckets/main-workspace/collections/search-config"
+        assert patch_requests[0]["body"] == {"data": {"status": "to-resign"}}
 
     @responses.activate
     def test_force_refresh_with_max_age_zero(self):
-        responses.add(responses.GET, self.server + "/", json=SERVER_INFO)
-
-        responses.add(
-            responses.GET,
-            self.server + "/buckets/monitor/collections/changes/records",
-            json=MONITOR_CHANGES,
-        )
-
         yesterday = (datetime.now() - timedelta(days=1)).replace(tzinfo=timezone.utc).isoformat()
         day_before = (datetime.now() - timedelta(days=2)).replace(tzinfo=timezone.utc).isoformat()
-
-        for cid, date in [
-            ("search-config", yesterday),
-            ("top-sites", day_before),
-        ]:
-            responses.add(
-                responses.GET,
-                self.server + "/buckets/main-workspace/collections/" + cid,
-                json={
-                    "data": {"last_modified": 42, "last_signature_date": date},
-                },
-            )
-            responses.add(
-                responses.PATCH,
-                self.server + "/buckets/main-workspace/collections/" + cid,
-                json={
-                    "data": {
-                        "last_modified": 43,
-                    }
-                },
-            )
+        self.mock_server(
+            [
+                {"id": "search-config", "last_modified": 42, "last_signature_date": yesterday},
+                {"id": "top-sites", "last_modified": 42, "last_signature_date": day_before},
+            ]
+        )
 
         refresh_signature(
             event={
@@ -131,6 +136,250 @@ class TestSignatureRefresh(unittest.TestCase):
             context=None,
         )
 
-        patch_requests = [r for r in responses.calls if r.request.method == "PATCH"]
+        patch_requests = self.batch_requests()
 
         assert len(patch_requests) == 2
+
+    @responses.activate
+    def test_metadata_is_fetched_in_bulk(self):
+        self.mock_server(
+            [
+                {"id": "search-config", "last_modified": 42},
+                {"id": "top-sites", "last_modified": 42},
+            ]
+        )
+
+        refresh_signature(event={"server": self.server}, context=None)
+
+        # Server info, monitor changes, collections listing, batch settings and batch.
+        assert len(responses.calls) == 5
+        assert len(self.batch_requests()) == 2
+
+    @responses.activate
+    def test_errors_are_aggregated(self):
+        self.mock_server(
+            [
+                {"id": "search-config", "last_modified": 42},
+                {"id": "top-sites", "last_modified": 42},
+            ],
+            batch_responses=[
+                {"status": 403, "body": {"message": "Unauthorized"}},
+                {"status": 200, "body": {"data": {"last_modified": 43}}},
+            ],
+        )
+
+        with pytest.raises(RefreshError) as exc_info:
+            refresh_signature(event={"server": self.server}, context=None)
+
+        assert "Unauthorized" in str(exc_info.value)
+        # The other collections are refreshed anyway.
+        assert len(self.batch_requests()) == 2
+
+    @responses.activate
+    def test_refreshes_are_sent_in_small_batches(self):
+        # The first batch fails because of the network, the next ones are sent anyway.
+        responses.add(
+            responses.POST,
+            self.server + "/batch",
+            body=requests.exceptions.ConnectionError("Connection reset"),
+        )
+        self.mock_server(
+            [
+                {"id": "search-config", "last_modified": 42},
+                {"id": "top-sites", "last_modified": 42},
+            ]
+        )
+
+        with mock.patch("commands.refresh_signature.REFRESH_SIGNATURE_BATCH_SIZE", 1):
+            with pytest.raises(RefreshError) as exc_info:
+                refresh_signature(event={"server": self.server}, context=None)
+
+        assert "Connection reset" in str(exc_info.value)
+        batches = [
+            json.loads(call.request.body)["requests"]
+            for call in responses.calls
+            if call.request.method == "POST"
+        ]
+        assert [len(batch) for batch in batches] == [1, 1]
+
+    @responses.activate
+    def test_missing_collections_are_reported(self):
+        self.mock_server([{"id": "top-sites", "last_modified": 42}])
+
+        with pytest.raises(RefreshError) as exc_info:
+            refresh_signature(event={"server": self.server}, context=None)
+
+        assert "main-workspace/search-config not found" in str(exc_info.value)
+        assert len(self.batch_requests()) == 1
+
+    @responses.activate
+    def test_budget_postpones_oldest_last(self):
+        self.mock_server(
+            [
+                {
+                    "id": "search-config",
+                    "last_modified": 42,
+                    "last_signature_date": "2019-01-11T15:11:07.807323+00:00",
+                },
+                {
+                    "id": "top-sites",
+                    "last_modified": 42,
+                    "last_signature_date": "2019-01-01T15:11:07.807323+00:00",
+                },
+            ]
+        )
+        patch = mock.patch("commands.refresh_signature.utcnow")
+        self.addCleanup(patch.stop)
+        patch.start().return_value = datetime(2019, 1, 20).replace(tzinfo=timezone.utc)
+
+        refresh_signature(event={"server": self.server, "refresh_budget": 1}, context=None)
+
+        patch_requests = self.batch_requests()
+        assert len(patch_requests) == 1
+        assert patch_requests[0]["path"] == "/buckets/main-workspace/collections/top-sites"
+
+    @responses.activate
+    def test_dry_run_reports_projected_load(self):
+        self.mock_server(
+            [
+                {"id": "search-config", "last_modified": 42},
+                {"id": "top-sites", "last_modified": 42},
+            ]
+        )
+
+        with mock.patch("commands.refresh_signature.DRY_MODE", True):
+            with mock.patch("builtins.print") as mocked_print:
+                refresh_signature(event={"server": self.server}, context=None)
+
+        assert self.batch_requests() == []
+        printed = [call[0][0] for call in mocked_print.call_args_list]
+        assert (
+            "Projected signatures refreshes on the next runs: [2, 0, 0, 0, 0, 0, 0, 2]" in printed
+        )
+
+    @responses.activate
+    def test_stagger_event_value_is_parsed(self):
+        for value, expected in [("0", False), ("false", False), (False, False), ("1", True)]:
+            with self.subTest(value=value):
+                responses.reset()
+                self.mock_server(
+                    [
+                        {"id": "search-config", "last_modified": 42},
+                        {"id": "top-sites", "last_modified": 42},
+                    ]
+                )
+                with mock.patch(
+                    "commands.refresh_signature.schedule_refresh", return_value=([], [])
+                ) as mocked:
+                    refresh_signature(
+                        event={"server": self.server, "stagger": value}, context=None
+                    )
+                nb_slots = mocked.call_args[0][3]
+                assert bool(nb_slots) is expected
+
+
+def test_get_collections_metadata_reports_network_errors():
+    client = mock.MagicMock()
+    client.session.server_url = "https://fake-server.net/v1"
+
+    def get_collections(bucket):
+        if bucket == "a":
+            raise requests.exceptions.ReadTimeout("Read timed out")
+        return [{"id": "cid"}]
+
+    client.get_collections.side_effect = get_collections
+
+    metadata, errors = get_collections_metadata(client, ["a", "b"])
+
+    assert metadata == {("b", "cid"): {"id": "cid"}}
+    assert list(errors) == ["a"]
+    assert isinstance(errors["a"], requests.exceptions.ReadTimeout)
+
+
+def test_get_signed_source():
+    server_info = {
+        "capabilities": {
+            "signer": {
+                "resources": [
+                    {
+                        "source": {"bucket": "security-state-staging", "collection": "onecrl"},
+                        "destination": {"bucket": "security-state", "collection": "onecrl"},
+                    },
+                    {
+                        "source": {"bucket": "main-workspace", "collection": None},
+                        "destination": {"bucket": "main", "collection": None},
+                    },
+                    {
+                        "source": {"bucket": "other-workspace", "collection": "regions"},
+                        "destination": {"bucket": "main", "collection": "regions"},
+                    },
+                ]
+            }
+        }
+    }
+    index = SignerIndex(server_info)
+
+    assert get_signed_source(index, {"bucket": "security-state", "collection": "onecrl"}) == {
+        "bucket": "security-state-staging",
+        "collection": "onecrl",
+    }
+    assert get_signed_source(index, {"bucket": "main", "collection": "top-sites"}) == {
+        "bucket": "main-workspace",
+        "collection": "top-sites",
+    }
+    # The per-collection resource takes precedence over the per-bucket one.
+    assert get_signed_source(index, {"bucket": "main", "collection": "regions"}) == {
+        "bucket": "other-workspace",
+        "collection": "regions",
+    }
+    assert get_signed_source(index, {"bucket": "main-preview", "collection": "regions"}) is None
+
+
+def sources(n):
+    return [{"bucket": "main-workspace", "collection": f"cid-{i}"} for i in range(n)]
+
+
+def test_schedule_refresh():
+    a, b, c, d = sources(4)
+    candidates = [(a, 3), (b, 8), (c, None), (d, 10)]
+
+    assert schedule_refresh(candidates, max_signature_age=7) == ([c, d, b], [])
+    assert schedule_refresh(candidates, max_signature_age=7, budget=2) == ([c, d], [b])
+
+
+def test_schedule_refresh_staggered():
+    candidates = [(source, 3) for source in sources(20)]
+    slots = {stagger_slot(source, 7) for source, _ in candidates}
+    run_index = slots.pop()
+
+    to_refresh, _ = schedule_refresh(
+        candidates, max_signature_age=7, nb_slots=7, run_index=run_index
+    )
+
+    assert 0 < len(to_refresh) < 20
+    assert all(stagger_slot(source, 7) == run_index for source in to_refresh)
+
+
+def test_stagger_slot_is_deterministic_and_spread():
+    counts = [0] * 7
+    for source in sources(7000):
+        slot = stagger_slot(source, 7)
+        assert slot == stagger_slot(dict(source), 7)
+        counts[slot] += 1
+
+    assert all(900 < count < 1100 for count in counts)
+
+
+def test_project_refresh_load():
+    # All signatures were created at the same time.
+    candidates = [(source, 6) for source in sources(70)]
+
+    assert project_refresh_load(candidates, max_signature_age=7) == [0, 70, 0, 0, 0, 0, 0, 0]
+
+    staggered = project_refresh_load(candidates, max_signature_age=7, nb_slots=7)
+    # Some are refreshed early, the rest once due, and then each on its own slot.
+    assert staggered[0] + staggered[1] == 70
+    assert max(staggered[2:]) < 20
+
+    with_budget = project_refresh_load(candidates, max_signature_age=7, budget=20)
+    assert max(with_budget) == 20